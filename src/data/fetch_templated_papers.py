@@ -1,51 +1,104 @@
 import os
+import shutil
+import tempfile
+import urllib.request
 
 import pandas as pd
 
 from src import TRIPLE_STORE_URL, RAW_DATA_DIR, ORKG_PAPERS_DUMP_URL
-from src.data.sparql.queries import TEMPLATED_PAPERS
-from src.data.sparql.service import query
+from src.data.sparql.queries import TEMPLATED_PAPERS, TEMPLATED_PAPERS_ORDERED
+from src.data.sparql.service import query, query_pages
 from src.util.io import Writer
 from src.util.string import id_to_uri
 
 PAPERS_PER_TEMPLATE_THRESHOLD = 2
+URI_COLUMNS = ['template', 'templateComponentProperty', 'templateOfResearchField', 'paper', 'paper_research_field']
+PAPER_COLUMNS = ['paper', 'paper_label', 'paper_research_field', 'paper_research_field_label', 'doi']
+PAGE_SIZE = 10000
+
+
+def read_papers_dump():
+    return pd.read_csv(ORKG_PAPERS_DUMP_URL).fillna('')
+
+
+def download_papers_dump():
+    """
+    Downloads the ORKG papers dump into a temporary file without loading it into memory.
+
+    :return: the path of the file, which must be deleted by the caller.
+    """
+    file_descriptor, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(file_descriptor, 'wb') as f, urllib.request.urlopen(ORKG_PAPERS_DUMP_URL) as response:
+        shutil.copyfileobj(response, f)
+
+    return path
+
+
+def read_abstracts(papers_dump_path, uris, chunk_size=PAGE_SIZE):
+    """
+    Reads the papers dump in chunks of ``chunk_size`` rows and only keeps the abstracts of ``uris``.
+
+    :return: see ``get_abstracts``.
+    """
+    abstracts = {}
+    for chunk in pd.read_csv(papers_dump_path, usecols=['uri', 'processed_abstract'], chunksize=chunk_size):
+        chunk = chunk[chunk.uri.isin(uris)].fillna('')
+
+        for uri, abstract in zip(chunk.uri, chunk.processed_abstract):
+            # the first row of a paper wins, like in ``get_abstracts``
+            if uri not in abstracts:
+                abstracts[uri] = abstract
+
+    return {uri: abstract for uri, abstract in abstracts.items() if abstract}
+
+
+def get_abstracts(papers_dump):
+    """
+    :return: dict of paper URI to its processed abstract. Papers without an abstract are left out.
+    """
+    papers_dump = papers_dump.drop_duplicates('uri')
+
+    return {uri: abstract for uri, abstract in zip(papers_dump.uri, papers_dump.processed_abstract) if abstract}
+
+
+def template_to_json(template_df, abstracts):
+    """
+    :param template_df: the rows of one template, with the URI columns already reduced to IDs.
+    :param abstracts: see ``get_abstracts``. Papers without an abstract are left out.
+    """
+    return {
+        'id': template_df.template.iloc[0],
+        'label': template_df.templateLabel.iloc[0],
+        'research_fields': [
+            {'id': id, 'label': label}
+            for (i, (id, label)) in template_df.loc[:, ['templateOfResearchField', 'templateOfResearchFieldLabel']
+                                    ].dropna().drop_duplicates().iterrows()
+        ],
+        'properties': template_df.templateComponentPropertyLabel.unique().tolist(),
+        'papers': [
+            {
+                'id': row[0],
+                'label': row[1],
+                'doi': row[4],
+                'research_field': {
+                    'id': row[2],
+                    'label': row[3]
+                },
+                'abstract': abstracts[id_to_uri(row[0])]
+            }
+            for (i, row) in template_df.loc[:, PAPER_COLUMNS].drop_duplicates().iterrows()
+            if id_to_uri(row[0]) in abstracts
+        ]
+    }
 
 
 def to_json(df, papers_dump):
-    uri_columns = ['template', 'templateComponentProperty', 'templateOfResearchField', 'paper', 'paper_research_field']
-    df[uri_columns] = df[uri_columns].applymap(lambda x: os.path.basename(str(x)))
+    df[URI_COLUMNS] = df[URI_COLUMNS].applymap(lambda x: os.path.basename(str(x)))
+    abstracts = get_abstracts(papers_dump)
 
     templated_papers = []
-    paper_columns = ['paper', 'paper_label', 'paper_research_field', 'paper_research_field_label', 'doi']
     for template_id in df.template.unique():
-        template_df = df[df.template == template_id]
-
-        template_json = {
-            'id': template_df.template.iloc[0],
-            'label': template_df.templateLabel.iloc[0],
-            'research_fields': [
-                {'id': id, 'label': label}
-                for (i, (id, label)) in template_df.loc[:, ['templateOfResearchField', 'templateOfResearchFieldLabel']
-                                        ].dropna().drop_duplicates().iterrows()
-            ],
-            'properties': template_df.templateComponentPropertyLabel.unique().tolist(),
-            'papers': [
-                {
-                    'id': row[0],
-                    'label': row[1],
-                    'doi': row[4],
-                    'research_field': {
-                        'id': row[2],
-                        'label': row[3]
-                    },
-                    'abstract': papers_dump[papers_dump.uri == id_to_uri(row[0])].processed_abstract.iloc[0]
-                }
-                for (i, row) in template_df.loc[:, paper_columns].drop_duplicates().iterrows()
-                if len(papers_dump[papers_dump.uri == id_to_uri(row[0])].processed_abstract.index) != 0
-                   and papers_dump[papers_dump.uri == id_to_uri(row[0])].processed_abstract.iloc[0]
-            ]
-        }
-        templated_papers.append(template_json)
+        templated_papers.append(template_to_json(df[df.template == template_id], abstracts))
 
     # filtering based on n_papers per template #
     filtered_templated_papers = []
@@ -60,6 +113,41 @@ def to_json(df, papers_dump):
     return filtered_templated_papers, list(set(templated_paper_ids))
 
 
+def stream(papers_dump_path, page_size=PAGE_SIZE):
+    """
+    Pages through the templated papers of the triple store and yields the templates one by one in the format of
+    ``to_json``, filtered by ``PAPERS_PER_TEMPLATE_THRESHOLD``. Only the current page, the rows of the current
+    template and their abstracts are kept in memory: the abstracts of every page are read from the papers dump
+    file at ``papers_dump_path`` in chunks, see ``download_papers_dump``.
+    """
+    template_df = None
+    abstracts = {}
+
+    for page in query_pages(TRIPLE_STORE_URL, TEMPLATED_PAPERS_ORDERED, page_size):
+        uris = set(page.paper.astype(str)) - abstracts.keys()
+        abstracts.update(read_abstracts(papers_dump_path, uris))
+        page[URI_COLUMNS] = page[URI_COLUMNS].applymap(lambda x: os.path.basename(str(x)))
+
+        # the rows are ordered by template, so a template is complete once the next one starts.
+        for template_id, rows in page.groupby('template', sort=False):
+            if template_df is not None and template_df.template.iloc[0] != template_id:
+                template = template_to_json(template_df, abstracts)
+                if len(template['papers']) >= PAPERS_PER_TEMPLATE_THRESHOLD:
+                    yield template
+                template_df = None
+
+            template_df = rows if template_df is None else pd.concat([template_df, rows])
+
+        # only the unfinished template is continued on the next page
+        pending = {id_to_uri(paper_id) for paper_id in template_df.paper} if template_df is not None else set()
+        abstracts = {uri: abstract for uri, abstract in abstracts.items() if uri in pending}
+
+    if template_df is not None:
+        template = template_to_json(template_df, abstracts)
+        if len(template['papers']) >= PAPERS_PER_TEMPLATE_THRESHOLD:
+            yield template
+
+
 def main(papers_dump):
     df = query(TRIPLE_STORE_URL, TEMPLATED_PAPERS)
     templated_papers, templated_paper_ids = to_json(df, papers_dump)
@@ -69,5 +157,4 @@ def main(papers_dump):
 
 
 if __name__ == '__main__':
-    dump = pd.read_csv(ORKG_PAPERS_DUMP_URL).fillna('')
-    main(dump)
+    main(read_papers_dump())
@@ -37,6 +37,14 @@ WHERE {
 }
 ORDER BY ?template"""
 
+# Ordered by all selected variables, so that LIMIT/OFFSET pages neither skip nor repeat rows.
+TEMPLATED_PAPERS_ORDERED = TEMPLATED_PAPERS.replace(
+    'ORDER BY ?template',
+    'ORDER BY ?template ?templateLabel ?templateComponentProperty ?templateComponentPropertyLabel '
+    '?templateOfResearchField ?templateOfResearchFieldLabel ?paper ?paper_label '
+    '?paper_research_field ?paper_research_field_label ?doi'
+)
+
 
 PAPERS_QUERY = """PREFIX orkgc: <http://orkg.org/orkg/class/>
     PREFIX orkgp: <http://orkg.org/orkg/predicate/>
@@ -18,3 +18,22 @@ def query(endpoint_url, sparql_query):
 
     _csv = StringIO(results)
     return pd.read_csv(_csv, sep=',').fillna('')
+
+
+def query_pages(endpoint_url, sparql_query, page_size):
+    """
+    Pages through the results of ``sparql_query`` with LIMIT/OFFSET and yields one DataFrame per page.
+
+    :param sparql_query: must order its results totally, otherwise pages may skip or repeat rows.
+    """
+    offset = 0
+    while True:
+        page = query(endpoint_url, '{}\nLIMIT {}\nOFFSET {}'.format(sparql_query, page_size, offset))
+
+        if len(page.index):
+            yield page
+
+        if len(page.index) < page_size:
+            return
+
+        offset += page_size
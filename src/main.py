@@ -1,64 +1,46 @@
+import importlib
 from argparse import ArgumentParser
 
-from src.data import main as data
-from src.models import train, evaluate, predict
+from src.models import registry
 
 
 def parse_args():
     parser = ArgumentParser()
 
     parser.add_argument('-t', '--task',
-                        choices=['dataset', 'train', 'evaluate', 'predict'],
+                        choices=list(registry.TASKS.keys()),
                         required=True,
                         help='Indicates the task to be executed. '
                              'dataset: fetches, analyses and splits the dataset. The file paths are fixed. '
                              'train: trains the provided approach using the provided training set. '
                              'evaluate: evaluates the provided approach using the provided test set. '
-                             'predict: predicts the provided approach using the provided query.'
+                             'predict: predicts the provided approach using the provided query. '
+                             'serve: serves the provided approach, or the default ones, over HTTP.'
                         )
 
     parser.add_argument('-a', '--approach',
-                        choices=['elasticsearch', 'scibert', 'baseline', 'baseline_full'],
+                        choices=list(registry.APPROACHES.keys()),
                         required=False,
                         help='Indicates the approach to do the task on.'
                         )
 
-    parser.add_argument('-trainp', '--training_set_path',
-                        type=str,
-                        required=False,
-                        help='Path to training set.'
-                        )
+    # only the arguments of the selected task and approaches are added, so that their modules are imported lazily
+    tasks = registry.peek('-t', '--task')
+    if tasks and tasks[0] in registry.TASKS:
+        task = importlib.import_module(registry.TASKS[tasks[0]])
 
-    parser.add_argument('-testp', '--test_set_path',
-                        type=str,
-                        required=False,
-                        help='Path to test set.'
-                        )
+        if hasattr(task, 'add_arguments'):
+            task.add_arguments(parser)
+            # serve defaults to its preloaded approaches
+            registry.add_arguments(parser, registry.peek('-a', '--approach') or getattr(task, 'APPROACHES', None))
 
-    parser.add_argument('-q', '--query',
-                        type=str,
-                        required=False,
-                        help='Paper textual representation. A concatenation of paper\'s title and DOI. '
-                        )
-
-    parser.add_argument('-n', '--n_results',
-                        type=int,
-                        default=20,
-                        required=False,
-                        help='Number of results to be retrieved.'
-                        )
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
 
-    {
-        'dataset': data.main,
-        'train': train.main,
-        'evaluate': evaluate.main,
-        'predict': predict.main
-    }[args.task](args)
+    registry.run_task(args.task, args)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,20 @@
 import os
+import sys
+import threading
+import time
+from types import MappingProxyType
 
 from src import MODELS_DIR
+from src.util.cache import file_digest
 from src.util.io import Reader, Writer
 
+# seconds between two checks whether a model file changed
+__RELOAD_INTERVAL__ = 1.0
+
+# model path to its (digest, time of the last check, research field ID to template IDs map)
+maps = {}
+lock = threading.Lock()
+
 
 def create_templates_fields_map(training_set_path, full=False):
     """
@@ -22,10 +34,8 @@ def create_templates_fields_map(training_set_path, full=False):
             else:
                 baseline_map[research_field['id']].append(template['id'])
 
-    if full:
-        Writer.write_json(baseline_map, os.path.join(MODELS_DIR, 'baseline_full.json'))
-    else:
-        Writer.write_json(baseline_map, os.path.join(MODELS_DIR, 'baseline.json'))
+    Writer.write_json(baseline_map, get_model_path(full))
+    maps.pop(get_model_path(full), None)
 
     print('model stored in {}'.format(MODELS_DIR))
 
@@ -35,17 +45,60 @@ def create_templates_fields_map(training_set_path, full=False):
     }
 
 
+def get_model_path(full=False):
+    return os.path.join(MODELS_DIR, 'baseline_full.json' if full else 'baseline.json')
+
+
+def get_map(full=False):
+    """
+    :return: the read-only map of research field IDs to tuples of template IDs. It is loaded once and only
+        reloaded if the content of the model file changed, which is checked at most every ``__RELOAD_INTERVAL__``
+        seconds.
+    """
+    path = get_model_path(full)
+    now = time.monotonic()
+
+    entry = maps.get(path)
+    if entry is not None and now - entry[1] < __RELOAD_INTERVAL__:
+        return entry[2]
+
+    with lock:
+        entry = maps.get(path)
+        digest = file_digest(path)
+
+        if entry is None or entry[0] != digest:
+            baseline_map = Reader.read_json(path)
+            # template IDs are shared by many research fields, interning keeps one copy of each.
+            baseline_map = MappingProxyType({sys.intern(research_field): tuple(sys.intern(template_id)
+                                                                                for template_id in template_ids)
+                                             for research_field, template_ids in baseline_map.items()})
+            entry = (digest, now, baseline_map)
+        else:
+            entry = (digest, now, entry[2])
+
+        maps[path] = entry
+
+    return entry[2]
+
+
 def query(q, full=False):
     """
     :param q: must be a research field ID
+    :return: tuple of the template IDs of the research field.
     """
-
-    if full:
-        baseline_map = Reader.read_json(os.path.join(MODELS_DIR, 'baseline_full.json'))
-    else:
-        baseline_map = Reader.read_json(os.path.join(MODELS_DIR, 'baseline.json'))
+    baseline_map = get_map(full)
 
     if q in baseline_map:
         return baseline_map[q]
 
-    return [None]  # important for the evaluation
+    return (None,)  # important for the evaluation
+
+
+def query_many(queries, full=False):
+    """
+    :param queries: research field IDs.
+    :return: list of the ``query`` results aligned with ``queries``.
+    """
+    baseline_map = get_map(full)
+
+    return [baseline_map.get(q, (None,)) for q in queries]
@@ -0,0 +1,184 @@
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+
+class Bm25Index:
+    """
+    Inverted index that ranks documents with the BM25 formula of Lucene, the similarity of Elasticsearch.
+
+    The term-document matrix is stored in compressed sparse column layout with one column per term, and every
+    entry already holds the BM25 weight of the term in the document. A query therefore only sums the columns
+    of its terms. The documents are grouped by template, so that the hits are collapsed by template with one
+    reduction. The arrays are memory-mapped at load:
+
+    * ``meta.json``: the number of documents, the average document length and the BM25 parameters.
+    * ``terms.json``: the vocabulary, the position of a term is its column.
+    * ``templates.json``: the template ID of every group of documents, None for the neutral papers.
+    * ``offsets.i64``: where the entries of every column start, followed by the number of entries.
+    * ``documents.i32``: the row of every entry.
+    * ``weights.f32``: the BM25 weight of every entry.
+    * ``groups.i64``: where the documents of every template start.
+    """
+    META_FILE_NAME = 'meta.json'
+    TERMS_FILE_NAME = 'terms.json'
+    TEMPLATES_FILE_NAME = 'templates.json'
+    OFFSETS_FILE_NAME = 'offsets.i64'
+    DOCUMENTS_FILE_NAME = 'documents.i32'
+    WEIGHTS_FILE_NAME = 'weights.f32'
+    GROUPS_FILE_NAME = 'groups.i64'
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+        with open(os.path.join(index_path, Bm25Index.META_FILE_NAME)) as f:
+            self.meta = json.load(f)
+
+        with open(os.path.join(index_path, Bm25Index.TERMS_FILE_NAME), encoding='utf-8') as f:
+            self.terms = {term: i for i, term in enumerate(json.load(f))}
+
+        with open(os.path.join(index_path, Bm25Index.TEMPLATES_FILE_NAME), encoding='utf-8') as f:
+            self.templates = json.load(f)
+
+        self.offsets = self.map(Bm25Index.OFFSETS_FILE_NAME, np.int64)
+        self.documents = self.map(Bm25Index.DOCUMENTS_FILE_NAME, np.int32)
+        self.weights = self.map(Bm25Index.WEIGHTS_FILE_NAME, np.float32)
+        self.groups = self.map(Bm25Index.GROUPS_FILE_NAME, np.int64)
+
+    @staticmethod
+    def create(index_path, documents, k1=None, b=None):
+        """
+        Tokenizes ``documents`` and writes a new index to ``index_path``.
+
+        :param documents: iterable of dicts with a ``text`` and a ``template_id``.
+        """
+        index = Bm25Index.build(documents, k1, b)
+
+        os.makedirs(index_path, exist_ok=True)
+        index.offsets.tofile(os.path.join(index_path, Bm25Index.OFFSETS_FILE_NAME))
+        index.documents.tofile(os.path.join(index_path, Bm25Index.DOCUMENTS_FILE_NAME))
+        index.weights.tofile(os.path.join(index_path, Bm25Index.WEIGHTS_FILE_NAME))
+        index.groups.tofile(os.path.join(index_path, Bm25Index.GROUPS_FILE_NAME))
+
+        with open(os.path.join(index_path, Bm25Index.TERMS_FILE_NAME), 'w', encoding='utf-8') as f:
+            json.dump(list(index.terms.keys()), f)
+
+        with open(os.path.join(index_path, Bm25Index.TEMPLATES_FILE_NAME), 'w', encoding='utf-8') as f:
+            json.dump(index.templates, f)
+
+        with open(os.path.join(index_path, Bm25Index.META_FILE_NAME), 'w') as f:
+            json.dump(index.meta, f, indent=4)
+
+        return Bm25Index(index_path)
+
+    @staticmethod
+    def build(documents, k1=None, b=None):
+        """
+        Tokenizes ``documents`` into an index that is only kept in memory, e.g. for the few template premises of
+        the scibert_cascade first stage.
+
+        :param documents: iterable of dicts with a ``text`` and a ``template_id``.
+        """
+        k1 = Bm25Index.K1 if k1 is None else k1
+        b = Bm25Index.B if b is None else b
+
+        templates = {}
+        for document in documents:
+            templates.setdefault(document['template_id'], []).append(Bm25Index.tokenize(document['text']))
+
+        vocabulary = {}
+        rows = []
+        columns = []
+        frequencies = []
+        lengths = []
+        groups = [0]
+        for tokens_list in templates.values():
+            for tokens in tokens_list:
+                for term, frequency in Counter(tokens).items():
+                    rows.append(len(lengths))
+                    columns.append(vocabulary.setdefault(term, len(vocabulary)))
+                    frequencies.append(frequency)
+
+                lengths.append(len(tokens))
+
+            groups.append(len(lengths))
+
+        rows = np.asarray(rows, dtype=np.int32)
+        columns = np.asarray(columns, dtype=np.int64)
+        frequencies = np.asarray(frequencies, dtype=np.float32)
+        lengths = np.asarray(lengths, dtype=np.float32)
+
+        n_documents = len(lengths)
+        average_length = float(lengths.mean()) if n_documents else 0.0
+        document_frequencies = np.bincount(columns, minlength=len(vocabulary))
+        idf = np.log(1 + (n_documents - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        norms = k1 * (1 - b + b * lengths / (average_length or 1))
+        weights = idf[columns] * frequencies / (frequencies + norms[rows])
+
+        order = np.argsort(columns, kind='stable')
+
+        index = Bm25Index.__new__(Bm25Index)
+        index.index_path = None
+        index.meta = {
+            'n_documents': n_documents,
+            'n_terms': len(vocabulary),
+            'average_length': average_length,
+            'k1': k1,
+            'b': b
+        }
+        index.terms = vocabulary
+        index.templates = list(templates.keys())
+        index.offsets = np.concatenate([[0], np.cumsum(document_frequencies)]).astype(np.int64)
+        index.documents = rows[order]
+        index.weights = weights[order].astype(np.float32)
+        index.groups = np.asarray(groups, dtype=np.int64)
+
+        return index
+
+    def map(self, file_name, dtype):
+        path = os.path.join(self.index_path, file_name)
+
+        # numpy cannot memory-map empty files
+        if not os.path.getsize(path):
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def search(self, q, k=5):
+        """
+        :return: the (score, template ID) tuples of the ``k`` templates with the best scoring documents.
+            Like an Elasticsearch match query, only documents that contain a query term are hits.
+        """
+        columns = [self.terms[term] for term in Bm25Index.tokenize(q) if term in self.terms]
+        if not columns or not self.meta['n_documents']:
+            return []
+
+        # a repeated query term adds its weight once per occurrence, as in Elasticsearch
+        columns, counts = np.unique(columns, return_counts=True)
+        documents = np.concatenate([self.documents[self.offsets[c]:self.offsets[c + 1]] for c in columns])
+        weights = np.concatenate([self.weights[self.offsets[c]:self.offsets[c + 1]] * n
+                                  for c, n in zip(columns, counts)])
+
+        scores = np.bincount(documents, weights=weights, minlength=self.meta['n_documents'])
+        scores = np.maximum.reduceat(scores, self.groups[:-1])
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if not k:
+            return []
+
+        top_k = np.argpartition(-scores, k - 1)[:k]
+        top_k = top_k[np.argsort(-scores[top_k], kind='stable')]
+
+        return [(float(scores[i]), self.templates[i]) for i in top_k]
+
+    @staticmethod
+    def tokenize(string):
+        """
+        Splits an already post-processed string into words, similar to the standard analyzer of Elasticsearch.
+        """
+        return re.findall(r'\w+', (string or '').lower())
@@ -0,0 +1,65 @@
+import itertools
+import os
+import threading
+
+from src import MODELS_DIR
+from src.models.bm25.index import Bm25Index
+from src.models.elasticsearch.document import DocumentCreator
+from src.util.io import Reader
+
+__INDEX_PATH__ = os.path.join(MODELS_DIR, 'bm25')
+
+index = None
+lock = threading.Lock()
+
+
+def get_index():
+    global index
+
+    with lock:
+        if index is None:
+            index = Bm25Index(__INDEX_PATH__)
+
+    return index
+
+
+def create_index(training_set_path):
+    """
+    Indexes the instances of the training set like the elasticsearch approach does, in a local BM25 index.
+    """
+    global index
+
+    index = Bm25Index.create(__INDEX_PATH__, generate_documents(training_set_path))
+
+    print('model stored in {}'.format(__INDEX_PATH__))
+
+    return {
+        'n_documents': index.meta['n_documents'],
+        'n_terms': index.meta['n_terms'],
+        'n_templates': len(index.templates)
+    }
+
+
+def generate_documents(training_set_path):
+    data = Reader.read_json(training_set_path)
+    for instance in itertools.chain(data['entailments'], data['neutrals']):
+
+        text = '{} {}'.format(instance['premise'], instance['hypothesis'])
+        yield {
+            'text': DocumentCreator.postprocess(text),
+            'template_id': instance['template_id']
+        }
+
+
+def query_index(q, top_k=5):
+    """
+    :return: dict of the ``top_k`` most similar template IDs to their best score, normalized by the best score
+        overall. The neutral papers are represented by the template ID None.
+    """
+    similar_templates = get_index().search(DocumentCreator.postprocess(q), k=top_k)
+
+    if not similar_templates:
+        return {}
+
+    max_score = similar_templates[0][0]
+    return {template_id: score / max_score for score, template_id in similar_templates}
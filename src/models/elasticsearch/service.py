@@ -1,50 +1,551 @@
-from elasticsearch import Elasticsearch
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import Elasticsearch, helpers
 
 from src.models.elasticsearch.document import DocumentCreator
 from src.util.io import Reader
+from src.util.lazy import lazy_import
+from src.util.string import post_process
 
-es = Elasticsearch(hosts=['localhost:9200'])
+fetch_templated_papers = lazy_import('src.data.fetch_templated_papers')
+split_dataset = lazy_import('src.data.split_dataset')
 
+# comma-separated hosts, e.g. es01:9200,es02:9200
+__HOSTS__ = os.environ.get('ELASTICSEARCH_HOSTS', 'localhost:9200').split(',')
+# connections per host, they are kept alive between requests
+__MAX_CONNECTIONS__ = 25
+__TIMEOUT__ = 30
+__MAX_RETRIES__ = 3
+# seconds the version of the index behind the alias is cached, see ``get_index_version``
+__VERSION_TTL__ = 10
+# alias of the current index version
 __INDEX_NAME__ = 'templates'
+__KEEP_VERSIONS__ = 2
+__CHUNK_SIZE__ = 500
+__BULK_THREADS__ = 4
+__MSEARCH_SIZE__ = 100
+__MSEARCH_THREADS__ = 4
+# documents are routed to shards by research field, see ``query_index``
+__N_SHARDS__ = 1
+__MIN_FIELD_RESULTS__ = 1
+__MAPPINGS__ = {
+    'properties': {
+        'text': {'type': 'text'},
+        # neutral papers have no template, they are collapsed into one group without a template_id.
+        'template_id': {'type': 'keyword'},
+        'research_field': {'type': 'keyword'},
+        # content hash of the other fields, compared by incremental updates
+        'hash': {'type': 'keyword', 'index': False}
+    }
+}
+
+es = None
+async_es = None
+lock = threading.Lock()
+
+# (version, time it was resolved)
+index_version = None
+
+
+def get_client():
+    """
+    :return: the shared client, created on first use. It is thread-safe and pools its connections.
+    """
+    global es
+
+    with lock:
+        if es is None:
+            es = Elasticsearch(**client_settings())
+
+    return es
+
+
+def get_async_client():
+    """
+    :return: the shared ``AsyncElasticsearch`` client, created on first use. It must be used within one event loop.
+    """
+    global async_es
+
+    if async_es is None:
+        from elasticsearch import AsyncElasticsearch
+
+        async_es = AsyncElasticsearch(**client_settings())
+
+    return async_es
+
+
+async def close_async_client():
+    global async_es
+
+    if async_es is not None:
+        await async_es.close()
+        async_es = None
+
+
+def client_settings():
+    return {
+        'hosts': __HOSTS__,
+        'maxsize': __MAX_CONNECTIONS__,
+        'timeout': __TIMEOUT__,
+        'max_retries': __MAX_RETRIES__,
+        'retry_on_timeout': True
+    }
+
+
+def recreate_index(training_set_path=None):
+    """
+    Builds a new version of the index and points the ``__INDEX_NAME__`` alias to it once it is validated, so that
+    queries are served by the previous version until then. Only the newest ``__KEEP_VERSIONS__`` versions are kept.
+
+    :param training_set_path: if None, the index is built directly from the triple store.
+    """
+    index_name = '{}_v{}'.format(__INDEX_NAME__, int(time.time() * 1000))
+
+    try:
+        info = create_index(index_name, training_set_path)
+        validate_index(index_name, info['indexedDocuments'])
+    except Exception:
+        get_client().indices.delete(index=index_name, ignore=[400, 404])
+        raise
+
+    swap_alias(index_name)
+    reset_index_version()
+
+    info['index'] = index_name
+    info['deletedIndices'] = collect_garbage()
+    return info
+
+
+def get_index_version():
+    """
+    :return: the name of the index version behind the alias and the time of its last incremental update,
+        which identify the results of a query. It is resolved at most every ``__VERSION_TTL__`` seconds.
+    """
+    entry = index_version
+    if entry is None or time.monotonic() - entry[1] >= __VERSION_TTL__:
+        entry = set_index_version(get_client().indices.get_mapping(index=__INDEX_NAME__))
+
+    return entry[0]
+
+
+async def get_index_version_async():
+    """
+    Same as ``get_index_version`` with the asynchronous client.
+    """
+    entry = index_version
+    if entry is None or time.monotonic() - entry[1] >= __VERSION_TTL__:
+        entry = set_index_version(await get_async_client().indices.get_mapping(index=__INDEX_NAME__))
+
+    return entry[0]
+
+
+def set_index_version(mappings):
+    global index_version
+
+    version = ['{}@{}'.format(index_name, mapping['mappings'].get('_meta', {}).get('updated', 0))
+               for index_name, mapping in sorted(mappings.items())]
 
+    index_version = (','.join(version), time.monotonic())
+    return index_version
 
-def recreate_index(training_set_path):
-    es.indices.delete(index=__INDEX_NAME__, ignore=[400, 404])
 
-    return create_index(training_set_path)
+def reset_index_version():
+    global index_version
 
+    index_version = None
 
-def create_index(training_set_path):
-    es.indices.create(index=__INDEX_NAME__, ignore=[400, 404])
-    indexed_documents = 0
-    not_indexed = []
 
-    # TODO: can we build the index directly from the triplestore ?
+def create_index(index_name, training_set_path=None):
+    """
+    :param index_name: name of the new index version, see ``recreate_index``.
+    :param training_set_path: if None, the index is built directly from the triple store.
+    """
+    # the source is compared by incremental updates, see ``update_index``
+    get_client().indices.create(index=index_name, body={
+        'settings': {'number_of_shards': __N_SHARDS__},
+        'mappings': dict(__MAPPINGS__, _meta={'source': get_document_source(training_set_path)})
+    }, ignore=[400, 404])
+
+    if training_set_path is None:
+        return bulk_index(generate_triplestore_documents(), index_name)
+
+    return bulk_index(generate_documents(training_set_path), index_name)
+
+
+def get_document_source(training_set_path=None):
+    """
+    :return: ``triplestore`` if the documents are read from the triple store, ``training_set`` otherwise.
+    """
+    return 'triplestore' if training_set_path is None else 'training_set'
+
+
+def get_index_source():
+    """
+    :return: the document source stored by ``create_index`` in the index behind the alias,
+        None for indices from before the source was stored.
+    """
+    mappings = get_client().indices.get_mapping(index=__INDEX_NAME__)
+    sources = {mapping['mappings'].get('_meta', {}).get('source') for mapping in mappings.values()}
+
+    return sources.pop() if len(sources) == 1 else None
+
+
+def validate_index(index_name, n_documents):
+    """
+    Checks that ``index_name`` holds ``n_documents`` documents and that a smoke query built from one of them
+    finds results.
+    """
+    count = get_client().count(index=index_name)['count']
+    if not count:
+        raise ValueError('{} holds no documents.'.format(index_name))
+
+    if count != n_documents:
+        raise ValueError('{} holds {} documents instead of {}.'.format(index_name, count, n_documents))
+
+    document = get_client().search(index=index_name, body={'size': 1})['hits']['hits'][0]['_source']
+    body = create_query_body(' '.join(document['text'].split()[:32]), 1)
+    if not collect_similar_templates(get_client().search(index=index_name, body=body)):
+        raise ValueError('The smoke query on {} found no results.'.format(index_name))
+
+
+def swap_alias(index_name):
+    """
+    Atomically points the ``__INDEX_NAME__`` alias from its current indices to ``index_name``.
+    An index named like the alias, from before the indices were versioned, is deleted in the same request.
+    """
+    actions = [{'add': {'index': index_name, 'alias': __INDEX_NAME__}}]
+
+    if get_client().indices.exists_alias(name=__INDEX_NAME__):
+        for old_index_name in get_client().indices.get_alias(name=__INDEX_NAME__).keys():
+            actions.insert(0, {'remove': {'index': old_index_name, 'alias': __INDEX_NAME__}})
+    elif get_client().indices.exists(index=__INDEX_NAME__):
+        actions.insert(0, {'remove_index': {'index': __INDEX_NAME__}})
+
+    get_client().indices.update_aliases(body={'actions': actions})
+
+
+def collect_garbage():
+    """
+    Deletes the index versions that are older than the newest ``__KEEP_VERSIONS__`` and not behind the alias.
+
+    :return: the names of the deleted indices.
+    """
+    versions = sorted(get_client().indices.get(index='{}_v*'.format(__INDEX_NAME__)).keys(), reverse=True)
+    aliased = set()
+    if get_client().indices.exists_alias(name=__INDEX_NAME__):
+        aliased = set(get_client().indices.get_alias(name=__INDEX_NAME__).keys())
+
+    deleted = [index_name for index_name in versions[__KEEP_VERSIONS__:] if index_name not in aliased]
+    for index_name in deleted:
+        get_client().indices.delete(index=index_name, ignore=[404])
+
+    return deleted
+
+
+def generate_documents(training_set_path):
+    """
+    Yields one document per training instance with its ``_id``, ``text`` and ``template_id``.
+    """
     data = Reader.read_json(training_set_path)
-    for instance in data['entailments'] + data['neutrals']:
+    for instance in itertools.chain(data['entailments'], data['neutrals']):
 
         text = '{} {}'.format(instance['premise'], instance['hypothesis'])
-        es.index(index=__INDEX_NAME__, id=instance['instance_id'], body={'text': DocumentCreator.postprocess(text)})
-        indexed_documents += 1
+        yield {
+            '_id': instance['instance_id'],
+            'text': DocumentCreator.postprocess(text),
+            'template_id': instance['template_id'],
+            'research_field': instance['research_field']['id']
+        }
+
+
+def generate_triplestore_documents():
+    """
+    Yields one document per templated paper of the triple store, with the same fields as the
+    instances of the training set. The templates are paged through and joined with the abstracts of the
+    papers dump on the fly, which is downloaded to a temporary file first.
+    """
+    papers_dump_path = fetch_templated_papers.download_papers_dump()
+
+    try:
+        for template in fetch_templated_papers.stream(papers_dump_path):
+            for paper in template['papers']:
+                premise, hypothesis = split_dataset.extract_premise_hypothesis(template, paper)
+
+                text = '{} {}'.format(post_process(premise), post_process(hypothesis))
+                yield {
+                    '_id': '{}x{}'.format(template['id'], paper['id']),
+                    'text': DocumentCreator.postprocess(text),
+                    'template_id': template['id'],
+                    'research_field': paper['research_field']['id']
+                }
+    finally:
+        os.remove(papers_dump_path)
+
+
+def bulk_index(documents, index_name=__INDEX_NAME__):
+    """
+    Indexes a stream of documents with ``__BULK_THREADS__`` parallel bulk requests of ``__CHUNK_SIZE__`` documents.
+    Refreshes and replicas are disabled during the load and restored afterwards.
+
+    :param documents: iterable of dicts with an ``_id`` and the document fields.
+    """
+    settings = get_client().indices.get_settings(index=index_name)[index_name]['settings']['index']
+    get_client().indices.put_settings(index=index_name, body={'index': {
+        'refresh_interval': '-1',
+        'number_of_replicas': 0
+    }})
+
+    try:
+        indexed_documents, not_indexed = send_bulk(create_index_action(document, index_name) for document in documents)
+    finally:
+        # refresh_interval is only part of the settings if it was set explicitly, None restores the default.
+        get_client().indices.put_settings(index=index_name, body={'index': {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings['number_of_replicas']
+        }})
+        get_client().indices.refresh(index=index_name)
 
     return {
         'indexedDocuments': indexed_documents,
-        'documents': len(data['entailments'] + data['neutrals']),
+        'documents': indexed_documents + len(not_indexed),
         'notIndexedDocuments': not_indexed
     }
 
 
-def query_index(q, top_k=5):
+def update_index(training_set_path=None):
+    """
+    Brings the current index version up to date with the training set or the triple store, by only indexing the
+    documents that are new or whose content hash changed and deleting the ones that no longer exist.
+
+    The index must have been built from the same source: the triple store only holds the templated papers, so an
+    update of a training set index from it would delete the neutral papers and add the papers of the test set.
+
+    :param training_set_path: if None, the documents are read directly from the triple store.
+    """
+    source = get_document_source(training_set_path)
+    index_source = get_index_source()
+    if index_source != source:
+        raise ValueError('{} was built from the source {} and cannot be updated from the source {}. '
+                         'Rebuild it instead.'.format(__INDEX_NAME__, index_source, source))
+
+    if training_set_path is None:
+        documents = generate_triplestore_documents()
+    else:
+        documents = generate_documents(training_set_path)
+
+    indexed = {hit['_id']: (hit['_source'].get('hash'), hit.get('_routing')) for hit in helpers.scan(
+        get_client(), index=__INDEX_NAME__, query={'_source': ['hash']}, size=__CHUNK_SIZE__)}
+
+    unchanged_documents = 0
+    changed = []
+    moved = []
+    for document in documents:
+        indexed_hash, routing = indexed.pop(document['_id'], (None, None))
+
+        if indexed_hash is not None and indexed_hash == hash_document(document):
+            unchanged_documents += 1
+            continue
+
+        changed.append(document)
+        # a document whose research field changed is indexed on another shard, its old copy must be deleted.
+        if indexed_hash is not None and routing != document.get('research_field'):
+            moved.append((document['_id'], routing))
+
+    # the documents left over are neither in the training set nor in the triple store anymore
+    deleted = [(_id, routing) for _id, (_, routing) in indexed.items()]
+
+    # the deletions go first, with a single shard the old copy of a moved document is its new copy as well.
+    _, not_deleted = send_bulk(create_delete_action(_id, routing, __INDEX_NAME__) for _id, routing in moved + deleted)
+    _, not_indexed = send_bulk(create_index_action(document, __INDEX_NAME__) for document in changed)
+    get_client().indices.refresh(index=__INDEX_NAME__)
+
+    # the update time is part of the index version, so that cached results of other processes are not reused.
+    get_client().indices.put_mapping(index=__INDEX_NAME__, body={'_meta': {
+        'source': source,
+        'updated': int(time.time() * 1000)
+    }})
+    reset_index_version()
+
+    return {
+        'indexedDocuments': len(changed),
+        'deletedDocuments': len(deleted),
+        'unchangedDocuments': unchanged_documents,
+        'notUpdatedDocuments': not_deleted + not_indexed
+    }
+
+
+def create_index_action(document, index_name):
+    source = {key: value for key, value in document.items() if key != '_id'}
+    source['hash'] = hash_document(source)
+
+    action = {'_index': index_name, '_op_type': 'index', '_id': document['_id'], '_source': source}
+    if document.get('research_field'):
+        action['_routing'] = document['research_field']
+
+    return action
+
+
+def create_delete_action(_id, routing, index_name):
+    action = {'_index': index_name, '_op_type': 'delete', '_id': _id}
+    if routing:
+        action['_routing'] = routing
+
+    return action
+
+
+def hash_document(document):
+    """
+    :return: a digest of the fields of ``document``, without its ``_id`` and ``hash``.
+    """
+    fields = {key: value for key, value in document.items() if key not in ['_id', 'hash']}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def send_bulk(actions):
+    """
+    Sends ``actions`` in ``__BULK_THREADS__`` parallel bulk requests of ``__CHUNK_SIZE__`` actions.
+
+    :return: the number of successful actions and the IDs and errors of the failed ones.
+    """
+    succeeded = 0
+    failed = []
+    for ok, item in helpers.parallel_bulk(get_client(), actions,
+                                          thread_count=__BULK_THREADS__,
+                                          chunk_size=__CHUNK_SIZE__,
+                                          raise_on_error=False,
+                                          raise_on_exception=False):
+        if ok:
+            succeeded += 1
+        else:
+            result = next(iter(item.values()))
+            failed.append({'id': result.get('_id'), 'error': result.get('error', result.get('exception'))})
+
+    return succeeded, failed
+
+
+def query_index(q, top_k=5, research_field=None):
+    """
+    :param research_field: research field ID of the query paper. If provided, only the shard and documents of
+        this research field are searched. The whole index is searched instead if this finds fewer than
+        ``__MIN_FIELD_RESULTS__`` templates.
+    :return: dict of the ``top_k`` most similar template IDs to their best score, normalized by the best score
+        overall. The neutral papers are represented by the template ID None.
+    """
+    body = create_query_body(q, top_k, research_field)
+
+    if not body:
+        return {}
+
+    if research_field:
+        interm_results = get_client().search(index=__INDEX_NAME__, body=body, routing=research_field)
+        similar_templates = collect_similar_templates(interm_results)
+
+        if len(similar_templates) >= __MIN_FIELD_RESULTS__:
+            return similar_templates
+
+        body = create_query_body(q, top_k)
+
+    interm_results = get_client().search(index=__INDEX_NAME__, body=body)
+
+    return collect_similar_templates(interm_results)
+
+
+async def query_index_async(q, top_k=5, research_field=None):
+    """
+    Same as ``query_index`` with the ``AsyncElasticsearch`` client, for callers that run in an event loop.
+    """
+    body = create_query_body(q, top_k, research_field)
+
+    if not body:
+        return {}
+
+    if research_field:
+        interm_results = await get_async_client().search(index=__INDEX_NAME__, body=body, routing=research_field)
+        similar_templates = collect_similar_templates(interm_results)
+
+        if len(similar_templates) >= __MIN_FIELD_RESULTS__:
+            return similar_templates
+
+        body = create_query_body(q, top_k)
+
+    interm_results = await get_async_client().search(index=__INDEX_NAME__, body=body)
+
+    return collect_similar_templates(interm_results)
+
+
+def query_index_many(queries, top_k=5, research_fields=None):
+    """
+    Sends the queries in ``_msearch`` requests of ``__MSEARCH_SIZE__`` queries, ``__MSEARCH_THREADS__`` of which
+    are sent concurrently.
+
+    :param research_fields: research field IDs aligned with ``queries``, see ``query_index``.
+    :return: list of the ``query_index`` results aligned with ``queries``.
+    """
+    research_fields = research_fields or [None] * len(queries)
+    requests = [(create_query_body(q, top_k, research_field), research_field)
+                for q, research_field in zip(queries, research_fields)]
+    chunks = [requests[i:i + __MSEARCH_SIZE__] for i in range(0, len(requests), __MSEARCH_SIZE__)]
+
+    with ThreadPoolExecutor(__MSEARCH_THREADS__) as executor:
+        results = [results for chunk_results in executor.map(msearch, chunks) for results in chunk_results]
+
+    fallback = [i for i, (body, research_field) in enumerate(requests)
+                if body and research_field and len(results[i]) < __MIN_FIELD_RESULTS__]
+    if fallback:
+        for i, similar_templates in zip(fallback, query_index_many([queries[i] for i in fallback], top_k)):
+            results[i] = similar_templates
+
+    return results
+
+
+def msearch(requests):
+    """
+    :param requests: list of (body, routing) tuples.
+    """
+    lines = []
+    for body, routing in requests:
+        if body:
+            lines.append(json.dumps({'index': __INDEX_NAME__, 'routing': routing} if routing else
+                                    {'index': __INDEX_NAME__}))
+            lines.append(body)
+
+    responses = iter(get_client().msearch(body='\n'.join(lines) + '\n')['responses'] if lines else [])
+
+    return [collect_similar_templates(next(responses)) if body else {} for body, _ in requests]
+
+
+def create_query_body(q, top_k, research_field=None):
+    """
+    :param research_field: if provided, only the documents of this research field match.
+    :return: the search request body of ``q`` as a JSON string, or None if nothing is left to search for.
+        The hits are collapsed by template, so that they are the best document of ``top_k`` distinct templates.
+    """
     query = DocumentCreator.postprocess(q, is_query=True)
 
     if not query:
-        return {}
+        return None
+
+    query = '{ "match" : { "text" : { "query" : "' + query + '" } } }'
+    if research_field:
+        query = '{ "bool" : { "must" : ' + query + ', "filter" : { "term" : { "research_field" : ' + \
+                json.dumps(research_field) + ' } } } }'
+
+    return '{"query": ' + query + ', "size":' + str(top_k) + \
+           ', "collapse": { "field": "template_id" }, "_source": false, "track_scores": true}'
 
-    body = '{"query": { "match" : { "text" : { "query" : "' + query + '" } } }, "size":' + str(top_k * 2) + '}'
-    interm_results = es.search(index=__INDEX_NAME__, body=body, track_scores=True)
 
+def collect_similar_templates(interm_results):
     try:
-        similar = {hit["_id"]: hit["_score"] for hit in interm_results["hits"]["hits"]}
+        similar = {}
+        for hit in interm_results['hits']['hits']:
+            # documents without a template_id are returned without the field or with a null value.
+            similar[hit.get('fields', {}).get('template_id', [None])[0]] = hit['_score']
 
         for key in similar.keys():
             # The first result will always have a score of 1.0
@@ -54,3 +555,87 @@ def query_index(q, top_k=5):
 
     except KeyError:
         return {}
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the elasticsearch approach that every task shares.
+    """
+    parser.add_argument('--msearch_size',
+                        type=int,
+                        default=__MSEARCH_SIZE__,
+                        required=False,
+                        help='Number of elasticsearch queries sent in one _msearch request.'
+                        )
+
+    parser.add_argument('--msearch_threads',
+                        type=int,
+                        default=__MSEARCH_THREADS__,
+                        required=False,
+                        help='Number of concurrent elasticsearch _msearch requests.'
+                        )
+
+    parser.add_argument('--min_field_results',
+                        type=int,
+                        default=__MIN_FIELD_RESULTS__,
+                        required=False,
+                        help='Elasticsearch queries with a research field search the whole index if the research '
+                             'field finds fewer templates. 0 disables this fallback.'
+                        )
+
+    parser.add_argument('--es_hosts',
+                        type=str,
+                        nargs='+',
+                        required=False,
+                        help='Elasticsearch hosts. Defaults to the comma-separated ELASTICSEARCH_HOSTS environment '
+                             'variable or localhost:9200.'
+                        )
+
+    parser.add_argument('--es_connections',
+                        type=int,
+                        default=__MAX_CONNECTIONS__,
+                        required=False,
+                        help='Number of connections per elasticsearch host that are kept alive in the pool.'
+                        )
+
+    parser.add_argument('--es_timeout',
+                        type=int,
+                        default=__TIMEOUT__,
+                        required=False,
+                        help='Timeout of elasticsearch requests in seconds.'
+                        )
+
+    parser.add_argument('--es_retries',
+                        type=int,
+                        default=__MAX_RETRIES__,
+                        required=False,
+                        help='Number of retries of failed or timed out elasticsearch requests.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the elasticsearch approach.
+    """
+    global __CHUNK_SIZE__, __BULK_THREADS__, __MSEARCH_SIZE__, __MSEARCH_THREADS__, __N_SHARDS__, \
+        __MIN_FIELD_RESULTS__, __HOSTS__, __MAX_CONNECTIONS__, __TIMEOUT__, __MAX_RETRIES__, es, async_es
+
+    __CHUNK_SIZE__ = getattr(config, 'chunk_size', None) or __CHUNK_SIZE__
+    __BULK_THREADS__ = getattr(config, 'bulk_threads', None) or __BULK_THREADS__
+    __MSEARCH_SIZE__ = getattr(config, 'msearch_size', None) or __MSEARCH_SIZE__
+    __MSEARCH_THREADS__ = getattr(config, 'msearch_threads', None) or __MSEARCH_THREADS__
+    __N_SHARDS__ = getattr(config, 'shards', None) or __N_SHARDS__
+
+    # 0 disables the fallback to the whole index
+    if getattr(config, 'min_field_results', None) is not None:
+        __MIN_FIELD_RESULTS__ = config.min_field_results
+
+    __HOSTS__ = getattr(config, 'es_hosts', None) or __HOSTS__
+    __MAX_CONNECTIONS__ = getattr(config, 'es_connections', None) or __MAX_CONNECTIONS__
+    __TIMEOUT__ = getattr(config, 'es_timeout', None) or __TIMEOUT__
+    if getattr(config, 'es_retries', None) is not None:
+        __MAX_RETRIES__ = config.es_retries
+
+    # the clients are created again with the new settings on their next use
+    es = None
+    async_es = None
@@ -1,32 +1,201 @@
+import copy
+import gc
 import os
+import resource
+import subprocess
+import sys
+import time
 from argparse import ArgumentParser
+from functools import partial
 
-from src.models import predict, train
+from src import CURRENT_DIR
+from src.models import predict, registry
 from src.util.io import Reader, Writer
+from src.util.lazy import lazy_import
 from src.util.string import extend_path
-from src.util.visualization import plot_research_fields_f_measures
+
+backends = lazy_import('src.models.scibert.backends')
+cascade = lazy_import('src.models.scibert.cascade')
+knn = lazy_import('src.models.knn.service')
+scibert = lazy_import('src.models.scibert.service')
+visualization = lazy_import('src.util.visualization')
+
+RSS_SCRIPT = """import gc
+from src.models.evaluate import get_rss
+from src.models.scibert import service
+gc.collect()
+rss = get_rss()
+predictor = service.TemplateSimilarityPredictor(backend='{backend}', precision='{precision}')
+print(get_rss() - rss)"""
 
 
 def parse_args():
     parser = ArgumentParser()
 
     parser.add_argument('-a', '--approach',
-                        choices=['elasticsearch', 'scibert', 'baseline', 'baseline_full'],
+                        choices=list(registry.APPROACHES.keys()),
                         required=True,
                         help='Indicates the approach to evaluate.'
                         )
 
+    add_arguments(parser)
+    registry.add_arguments(parser, registry.peek('-a', '--approach'))
+    return parser.parse_args()
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the evaluate task. The ones of the approaches are added by the registry.
+    """
     parser.add_argument('-testp', '--test_set_path',
                         type=str,
                         required=True,
                         help='Path to test set.'
                         )
-    return parser.parse_args()
+
+    parser.add_argument('--compare_precisions',
+                        action='store_true',
+                        help='Evaluates the scibert approach in every precision and reports the F1, '
+                             'latency and memory differences to fp32.'
+                        )
 
 
 def evaluate_elasticsearch(test_set_path):
     test_set = Reader.read_json(test_set_path)
+    instances = test_set['entailments'] + test_set['contradictions'] + test_set['neutrals']
+
+    # the queries are sent in _msearch batches up front, the metrics look their results up
+    print('Querying {} instances...'.format(len(instances)))
+    results = predict.predict_elasticsearch_many([instance['hypothesis'] for instance in instances])
+    results = {id(instance): instance_results for instance, instance_results in zip(instances, results)}
+
+    metrics = compute_ranking_metrics(test_set, lambda instance: results[id(instance)])
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_es_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'es_results.png'))
+
+    return metrics
+
+
+def evaluate_bm25(test_set_path):
+    test_set = Reader.read_json(test_set_path)
+
+    metrics = compute_ranking_metrics(test_set, lambda instance: predict.predict_bm25(instance['hypothesis']))
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_bm25_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'bm25_results.png'))
+
+    return metrics
+
+
+def evaluate_scibert(test_set_path):
+    test_set = Reader.read_json(test_set_path)
+
+    metrics = compute_scibert_metrics(test_set, lambda instance: predict.predict_scibert(instance['hypothesis']))
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_scibert_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'scibert_results.png'))
+
+    return metrics
+
+
+def evaluate_scibert_precisions(test_set_path):
+    """
+    Evaluates every precision mode of the SciBERT predictor and reports its F1 delta against fp32 together with
+    the average query latency and the resident memory taken by the model.
+    Memory is measured as the RSS growth while loading the model in a fresh interpreter, after the reduced-precision
+    weights have been stored by the evaluation.
+    """
+    test_set = Reader.read_json(test_set_path)
+    n_instances = len(test_set['entailments'] + test_set['contradictions'] + test_set['neutrals'])
+
+    report = {}
+    for precision in backends.PRECISIONS:
+        predictor = scibert.TemplateSimilarityPredictor(precision=precision)
+
+        start = time.perf_counter()
+        metrics = compute_scibert_metrics(copy.deepcopy(test_set),
+                                          partial(predict_scibert_instance, predictor))
+        latency = (time.perf_counter() - start) / n_instances
+
+        report[precision] = {
+            'f1': metrics['f1'],
+            'f1_delta': metrics['f1'] - report['fp32']['f1'] if report else 0.0,
+            'latency_ms': latency * 1000,
+            'rss_mb': measure_model_rss(precision) / 2 ** 20
+        }
+        del predictor
+        gc.collect()
+
+    for precision in backends.PRECISIONS:
+        for measure, saving in [('latency_ms', 'latency_saving'), ('rss_mb', 'rss_saving')]:
+            try:
+                report[precision][saving] = 1 - report[precision][measure] / report['fp32'][measure]
+            except ZeroDivisionError:
+                report[precision][saving] = 0.0
+
+    return report
+
+
+def evaluate_scibert_cascade(test_set_path):
+    test_set = Reader.read_json(test_set_path)
+
+    metrics = compute_scibert_metrics(test_set, lambda instance: predict.predict_scibert_cascade(
+        instance['hypothesis'], research_field=instance['research_field']['id']))
+    metrics['first_stage_recall'] = compute_first_stage_recall(test_set)
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_scibert_cascade_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'scibert_cascade_results.png'))
+
+    return metrics
 
+
+def evaluate_scibert_biencoder(test_set_path):
+    test_set = Reader.read_json(test_set_path)
+
+    metrics = compute_ranking_metrics(test_set, lambda instance: predict.predict_scibert_biencoder(
+        instance['hypothesis']))
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_scibert_biencoder_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'scibert_biencoder_results.png'))
+
+    return metrics
+
+
+def evaluate_scibert_knn(test_set_path):
+    test_set = Reader.read_json(test_set_path)
+
+    instances = test_set['entailments'] + test_set['contradictions'] + test_set['neutrals']
+
+    metrics = compute_ranking_metrics(test_set, lambda instance: predict.predict_scibert_knn(instance['hypothesis']))
+    # recall of the approximate search against exact search over the same index
+    metrics['ann_recall'] = knn.measure_recall([instance['hypothesis'] for instance in instances])
+    test_set['metrics'] = metrics
+    Writer.write_json(test_set, extend_path(test_set_path, '_scibert_knn_evaluated'))
+
+    plot = visualization.plot_research_fields_f_measures(metrics)
+    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'scibert_knn_results.png'))
+
+    return metrics
+
+
+def compute_ranking_metrics(test_set, predict_fn):
+    """
+    Evaluates approaches that rank templates without differentiating between entailments and neutrals,
+    by their top-1 result.
+
+    :param predict_fn: maps a test set instance to a list of ranked templates.
+    """
     # including the neutral template
     n_templates = len(list(set([entailment['template_id'] for entailment in test_set['entailments']]))) + 1
 
@@ -38,36 +207,46 @@ def evaluate_elasticsearch(test_set_path):
 
     for i, instance in enumerate(instances):
         print('{}/{} - instance {}'.format(i + 1, len(instances), instance['instance_id']))
-        instance['results'] = predict.predict_elasticsearch(instance['hypothesis'])
+        instance['results'] = predict_fn(instance)
 
-        elasticsearch_entailments = instance['results'][:1]  # ignore fp
-        elasticsearch_results = extract_top_k_results(instance['results'], 1)
+        entailments = instance['results'][:1]  # ignore fp
+        results = extract_top_k_results(instance['results'], 1)
 
-        # ES doesn't differentiate between neutrals and entailments
-        if instance['template_id'] in elasticsearch_results:
-            accuracy += n_templates - len(elasticsearch_entailments) + 1
+        if instance['template_id'] in results:
+            accuracy += n_templates - len(entailments) + 1
             tp += 1
-            fp += len(elasticsearch_entailments) - 1
+            fp += len(entailments) - 1
             research_fields[instance['research_field']['id']]['tp'] += 1
-            research_fields[instance['research_field']['id']]['fp'] += len(elasticsearch_entailments) - 1
+            research_fields[instance['research_field']['id']]['fp'] += len(entailments) - 1
         else:
-            accuracy += n_templates - len(elasticsearch_entailments)
-            fp += len(elasticsearch_entailments)
-            research_fields[instance['research_field']['id']]['fp'] += len(elasticsearch_entailments)
+            accuracy += n_templates - len(entailments)
+            fp += len(entailments)
+            research_fields[instance['research_field']['id']]['fp'] += len(entailments)
 
-    metrics = compute_metrics(len(instances), n_templates, accuracy, tp, fp, research_fields)
-    test_set['metrics'] = metrics
-    Writer.write_json(test_set, extend_path(test_set_path, '_es_evaluated'))
+    return compute_metrics(len(instances), n_templates, accuracy, tp, fp, research_fields)
 
-    plot = plot_research_fields_f_measures(metrics)
-    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'es_results.png'))
 
-    return metrics
+def compute_first_stage_recall(test_set):
+    """
+    :return: the share of entailments whose template is among the candidates of the cascade's first stage.
+    """
+    templates = scibert.TemplateSimilarityPredictor.get_instance().load_premises()['templates']
+    selector = cascade.TemplateCandidateSelector.get_instance()
 
+    hits = 0
+    for instance in test_set['entailments']:
+        candidates = selector.select(instance['hypothesis'], templates, instance['research_field']['id'])
+        if instance['template_id'] in candidates:
+            hits += 1
+
+    return hits / len(test_set['entailments']) if test_set['entailments'] else 0.0
 
-def evaluate_scibert(test_set_path):
-    test_set = Reader.read_json(test_set_path)
 
+def compute_scibert_metrics(test_set, predict_fn):
+    """
+    :param predict_fn: maps a test set instance to a list of similar templates as returned by
+        ``predict.predict_scibert``.
+    """
     # including the neutral template
     n_templates = len(list(set([entailment['template_id'] for entailment in test_set['entailments']]))) + 1
 
@@ -79,7 +258,7 @@ def evaluate_scibert(test_set_path):
 
     for i, instance in enumerate(instances):
         print('{}/{} - instance {}'.format(i + 1, len(instances), instance['instance_id']))
-        instance['results'] = predict.predict_scibert(instance['hypothesis'])
+        instance['results'] = predict_fn(instance)
 
         bert_entailments = instance['results'][:1]  # ignore fp
         bert_results = extract_top_k_results(bert_entailments, 1)
@@ -108,14 +287,7 @@ def evaluate_scibert(test_set_path):
                 tp += 1
                 research_fields[instance['research_field']['id']]['tp'] += 1
 
-    metrics = compute_metrics(len(instances), n_templates, accuracy, tp, fp, research_fields)
-    test_set['metrics'] = metrics
-    Writer.write_json(test_set, extend_path(test_set_path, '_scibert_evaluated'))
-
-    plot = plot_research_fields_f_measures(metrics)
-    Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'scibert_results.png'))
-
-    return metrics
+    return compute_metrics(len(instances), n_templates, accuracy, tp, fp, research_fields)
 
 
 def evaluate_baseline(test_set_path):
@@ -130,9 +302,12 @@ def evaluate_baseline(test_set_path):
     instances = test_set['entailments'] + test_set['contradictions'] + test_set['neutrals']
     research_fields = init_research_fields_metrics(instances)
 
-    for i, instance in enumerate(instances):
-        print('{}/{} - instance {}'.format(i + 1, len(instances), instance['instance_id']))
-        instance['results'] = predict.predict_baseline(instance['research_field']['id'])  # here the trick
+    print('Querying {} instances...'.format(len(instances)))
+    # here the trick
+    results = predict.predict_baseline_many([instance['research_field']['id'] for instance in instances])
+
+    for instance, instance_results in zip(instances, results):
+        instance['results'] = instance_results
 
         baseline_entailments = instance['results'][:1]  # ignore fp
         baseline_results = extract_top_k_results(instance['results'], 1)
@@ -153,7 +328,7 @@ def evaluate_baseline(test_set_path):
     test_set['metrics'] = metrics
     Writer.write_json(test_set, extend_path(test_set_path, '_baseline_evaluated'))
 
-    plot = plot_research_fields_f_measures(metrics)
+    plot = visualization.plot_research_fields_f_measures(metrics)
     Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'baseline_results.png'))
 
     return metrics
@@ -171,9 +346,12 @@ def evaluate_baseline_full(test_set_path):
     instances = test_set['entailments'] + test_set['contradictions'] + test_set['neutrals']
     research_fields = init_research_fields_metrics(instances)
 
-    for i, instance in enumerate(instances):
-        print('{}/{} - instance {}'.format(i + 1, len(instances), instance['instance_id']))
-        instance['results'] = predict.predict_baseline_full(instance['research_field']['id'])  # here the trick
+    print('Querying {} instances...'.format(len(instances)))
+    # here the trick
+    results = predict.predict_baseline_many([instance['research_field']['id'] for instance in instances], full=True)
+
+    for instance, instance_results in zip(instances, results):
+        instance['results'] = instance_results
 
         baseline_entailments = instance['results'][:1]  # ignore fp
         baseline_results = extract_top_k_results(instance['results'], 1)
@@ -194,7 +372,7 @@ def evaluate_baseline_full(test_set_path):
     test_set['metrics'] = metrics
     Writer.write_json(test_set, extend_path(test_set_path, '_baseline_full_evaluated'))
 
-    plot = plot_research_fields_f_measures(metrics)
+    plot = visualization.plot_research_fields_f_measures(metrics)
     Writer.write_png(plot, os.path.join(os.path.split(test_set_path)[0], 'baseline_full_results.png'))
 
     return metrics
@@ -254,16 +432,60 @@ def compute_metrics(n_instances, n_templates, accuracy, tp, fp, research_fields)
     }
 
 
+def predict_scibert_instance(predictor, instance):
+    return predictor.predict_similar_templates(instance['hypothesis'])
+
+
+def measure_model_rss(precision):
+    """
+    Measures in a fresh interpreter how much the resident set size grows while the SciBERT predictor of
+    ``precision`` is loaded, so that memory freed by earlier models does not distort the result.
+
+    :return: the RSS growth in bytes.
+    """
+    script = RSS_SCRIPT.format(backend=scibert.TemplateSimilarityPredictor.BACKEND, precision=precision)
+    output = subprocess.run([sys.executable, '-c', script],
+                            cwd=os.path.join(CURRENT_DIR, '..'),
+                            capture_output=True,
+                            check=True,
+                            text=True).stdout
+
+    return int(output.strip().splitlines()[-1])
+
+
+def get_rss():
+    """
+    :return: the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # peak RSS in kilobytes on Linux, the best we can get without procfs.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def main(config=None):
     args = config or parse_args()
 
     assert args.approach, 'approach must be provided.'
     assert args.test_set_path, 'test_set_path must be provided.'
 
+    registry.configure(args.approach, args)
+
+    if args.approach == 'scibert' and args.compare_precisions:
+        print('Comparing scibert precisions...')
+        print(evaluate_scibert_precisions(args.test_set_path))
+        return
+
     print('Evaluating {}...'.format(args.approach))
     results = {
         'elasticsearch': evaluate_elasticsearch,
+        'bm25': evaluate_bm25,
         'scibert': evaluate_scibert,
+        'scibert_cascade': evaluate_scibert_cascade,
+        'scibert_biencoder': evaluate_scibert_biencoder,
+        'scibert_knn': evaluate_scibert_knn,
         'baseline': evaluate_baseline,
         'baseline_full': evaluate_baseline_full
     }[args.approach](args.test_set_path)
@@ -0,0 +1,279 @@
+import json
+import os
+
+import numpy as np
+
+
+class IvfIndex:
+    """
+    Inverted-file approximate nearest neighbour index over L2-normalized float32 vectors.
+
+    Vectors are assigned to the closest of ``n_lists`` k-means centroids. A query only scans the vectors of its
+    ``n_probe`` closest centroids. The vectors are memory-mapped at load and stored grouped by centroid up to the
+    last compaction, so that a list is scanned as a contiguous slice. Inserted vectors are appended to the files
+    and scanned by row lookups until the next ``compact``, which replaces the files atomically. The number of lists
+    probed by default is tuned on the indexed vectors to reach a recall of ``RECALL_TARGET`` against exact search:
+
+    * ``meta.json``: the dimension, the number of compacted vectors and the tuned number of probes.
+    * ``centroids.npy``: the coarse quantizer.
+    * ``vectors.f32``: one row per vector.
+    * ``lists.i32``: the centroid of each vector.
+    * ``labels.jsonl``: one JSON payload per vector.
+    """
+    META_FILE_NAME = 'meta.json'
+    CENTROIDS_FILE_NAME = 'centroids.npy'
+    VECTORS_FILE_NAME = 'vectors.f32'
+    LISTS_FILE_NAME = 'lists.i32'
+    LABELS_FILE_NAME = 'labels.jsonl'
+    KMEANS_ITERATIONS = 20
+    KMEANS_SAMPLE_SIZE = 100000
+    RECALL_TARGET = 0.9
+    RECALL_SAMPLE_SIZE = 200
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+        with open(os.path.join(index_path, IvfIndex.META_FILE_NAME)) as f:
+            self.meta = json.load(f)
+
+        self.dimension = self.meta['dimension']
+
+        self.centroids = np.load(os.path.join(index_path, IvfIndex.CENTROIDS_FILE_NAME))
+
+        with open(os.path.join(index_path, IvfIndex.LABELS_FILE_NAME), encoding='utf-8') as f:
+            self.labels = [json.loads(line) for line in f]
+
+        self.vectors = None
+        self.offsets = None
+        self.appended_order = None
+        self.appended_offsets = None
+        self.load()
+
+    @staticmethod
+    def create(index_path, vectors, labels, n_lists=None, k=10):
+        """
+        Trains the coarse quantizer on ``vectors`` and writes a new index to ``index_path``.
+
+        :param vectors: float32 matrix with one L2-normalized row per item.
+        :param labels: JSON-serializable payloads aligned with ``vectors``.
+        :param n_lists: number of centroids. Defaults to the square root of the number of vectors.
+        :param k: number of neighbours the number of probed lists is tuned for.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+
+        os.makedirs(index_path, exist_ok=True)
+        for file_name in [IvfIndex.VECTORS_FILE_NAME, IvfIndex.LISTS_FILE_NAME, IvfIndex.LABELS_FILE_NAME]:
+            open(os.path.join(index_path, file_name), 'wb').close()
+
+        np.save(os.path.join(index_path, IvfIndex.CENTROIDS_FILE_NAME), IvfIndex.kmeans(vectors, n_lists))
+        with open(os.path.join(index_path, IvfIndex.META_FILE_NAME), 'w') as f:
+            json.dump({'dimension': vectors.shape[1], 'n_lists': n_lists, 'n_compacted': 0}, f, indent=4)
+
+        index = IvfIndex(index_path)
+        index.insert(vectors, labels)
+        index.compact()
+        index.tune(k)
+
+        return index
+
+    def load(self):
+        """
+        Memory-maps the vectors and computes where the rows of each centroid are.
+        """
+        vectors_path = os.path.join(self.index_path, IvfIndex.VECTORS_FILE_NAME)
+        n_vectors = os.path.getsize(vectors_path) // (4 * self.dimension)
+
+        if n_vectors:
+            self.vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(n_vectors, self.dimension))
+            lists = np.fromfile(os.path.join(self.index_path, IvfIndex.LISTS_FILE_NAME), dtype=np.int32)[:n_vectors]
+        else:
+            self.vectors = np.zeros((0, self.dimension), dtype=np.float32)
+            lists = np.zeros(0, dtype=np.int32)
+
+        n_compacted = self.meta['n_compacted']
+        self.offsets = IvfIndex.list_offsets(lists[:n_compacted], len(self.centroids))
+        self.appended_order = n_compacted + np.argsort(lists[n_compacted:], kind='stable')
+        self.appended_offsets = IvfIndex.list_offsets(lists[n_compacted:], len(self.centroids))
+
+    def compact(self):
+        """
+        Rewrites the index files grouped by centroid, so that every list can be scanned as a contiguous slice.
+        The files are written next to the current ones and swapped in, processes that still map the old files keep
+        reading them.
+        """
+        lists = np.fromfile(os.path.join(self.index_path, IvfIndex.LISTS_FILE_NAME), dtype=np.int32)
+        order = np.argsort(lists, kind='stable')
+        vectors = np.asarray(self.vectors)[order]
+        labels = [self.labels[i] for i in order]
+
+        self.replace_file(IvfIndex.VECTORS_FILE_NAME, lambda f: vectors.tofile(f))
+        self.replace_file(IvfIndex.LISTS_FILE_NAME, lambda f: lists[order].tofile(f))
+        self.replace_file(IvfIndex.LABELS_FILE_NAME, lambda f: IvfIndex.write_labels(f, labels))
+
+        self.meta['n_compacted'] = len(lists)
+        self.write_meta()
+
+        self.labels = labels
+        self.load()
+
+    def update_labels(self, labels):
+        """
+        Replaces the payloads of indexed vectors.
+
+        :param labels: dict of row to its new payload.
+        """
+        self.labels = [labels.get(i, label) for i, label in enumerate(self.labels)]
+        self.replace_file(IvfIndex.LABELS_FILE_NAME, lambda f: IvfIndex.write_labels(f, self.labels))
+
+    def replace_file(self, file_name, write):
+        """
+        Writes a file of the index to a temporary file with ``write`` and moves it over the current one.
+        """
+        path = os.path.join(self.index_path, file_name)
+        with open(path + '.tmp', 'wb') as f:
+            write(f)
+
+        os.replace(path + '.tmp', path)
+
+    def write_meta(self):
+        self.replace_file(IvfIndex.META_FILE_NAME, lambda f: f.write(json.dumps(self.meta, indent=4).encode('utf-8')))
+
+    @staticmethod
+    def write_labels(f, labels):
+        for label in labels:
+            f.write((json.dumps(label) + '\n').encode('utf-8'))
+
+    def insert(self, vectors, labels):
+        """
+        Appends vectors and their payloads to the index without retraining the centroids.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        lists = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+        with open(os.path.join(self.index_path, IvfIndex.VECTORS_FILE_NAME), 'ab') as f:
+            vectors.tofile(f)
+
+        with open(os.path.join(self.index_path, IvfIndex.LISTS_FILE_NAME), 'ab') as f:
+            lists.tofile(f)
+
+        with open(os.path.join(self.index_path, IvfIndex.LABELS_FILE_NAME), 'a', encoding='utf-8') as f:
+            for label in labels:
+                f.write(json.dumps(label) + '\n')
+
+        self.labels.extend(labels)
+        self.load()
+
+    def search(self, vector, k=10, n_probe=None):
+        """
+        :param n_probe: number of lists to scan, defaults to the tuned number, see ``tune``.
+        :return: the (similarity, label) tuples of the ``k`` approximately most similar vectors.
+        """
+        similarities, rows = self.search_rows(vector, k, n_probe)
+
+        return [(float(similarity), self.labels[row]) for similarity, row in zip(similarities, rows)]
+
+    def search_rows(self, vector, k=10, n_probe=None):
+        """
+        :return: the similarities and the rows of the ``k`` approximately most similar vectors, most similar first.
+        """
+        n_probe = min(n_probe or self.meta.get('n_probe', 4), len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ vector), n_probe - 1)[:n_probe]
+
+        rows = []
+        similarities = []
+        for i in lists:
+            start, end = self.offsets[i], self.offsets[i + 1]
+            rows.append(np.arange(start, end))
+            similarities.append(self.vectors[start:end] @ vector)
+
+            appended_rows = self.appended_order[self.appended_offsets[i]:self.appended_offsets[i + 1]]
+            rows.append(appended_rows)
+            similarities.append(self.vectors[appended_rows] @ vector)
+
+        rows = np.concatenate(rows)
+        similarities = np.concatenate(similarities)
+        if not len(rows):
+            return similarities, rows
+
+        k = min(k, len(rows))
+        top_k = np.argpartition(-similarities, k - 1)[:k]
+        top_k = top_k[np.argsort(-similarities[top_k])]
+
+        return similarities[top_k], rows[top_k]
+
+    def recall(self, queries, k=10, n_probe=None, rows=None):
+        """
+        :param queries: float32 matrix with one L2-normalized query per row.
+        :param rows: the indexed rows the queries were taken from, which are not counted as their neighbours.
+        :return: the average share of the exact ``k`` nearest neighbours that ``search_rows`` finds.
+        """
+        recalls = []
+        for i, query in enumerate(queries):
+            excluded = set() if rows is None else {int(rows[i])}
+            n = min(k + len(excluded), len(self.vectors))
+            if not n:
+                continue
+
+            similarities = np.asarray(self.vectors @ query)
+            exact = np.argpartition(-similarities, n - 1)[:n]
+            exact = [row for row in exact.tolist() if row not in excluded][:k]
+            found = [row for row in self.search_rows(query, n, n_probe)[1].tolist() if row not in excluded][:k]
+
+            if exact:
+                recalls.append(len(set(exact) & set(found)) / len(exact))
+
+        return float(np.mean(recalls)) if recalls else 1.0
+
+    def tune(self, k=10):
+        """
+        Chooses the smallest number of probed lists (1, 2, 4, ...) whose recall@``k`` on a sample of the indexed
+        vectors reaches ``RECALL_TARGET`` and stores it in the meta file.
+
+        :return: dict of the number of probed lists to its recall.
+        """
+        random = np.random.default_rng(10)
+        n_vectors = len(self.vectors)
+        sample = np.sort(random.choice(n_vectors, min(n_vectors, IvfIndex.RECALL_SAMPLE_SIZE), replace=False))
+        queries = np.asarray(self.vectors[sample])
+
+        recalls = {}
+        n_probe = 1
+        while True:
+            recalls[n_probe] = self.recall(queries, k, n_probe, rows=sample)
+            if recalls[n_probe] >= IvfIndex.RECALL_TARGET or n_probe >= len(self.centroids):
+                break
+            n_probe = min(n_probe * 2, len(self.centroids))
+
+        self.meta['n_probe'] = n_probe
+        self.meta['recall'] = recalls[n_probe]
+        self.write_meta()
+
+        return recalls
+
+    @staticmethod
+    def list_offsets(lists, n_lists):
+        return np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=n_lists))])
+
+    @staticmethod
+    def kmeans(vectors, n_lists):
+        """
+        Spherical k-means on a sample of the vectors.
+        """
+        random = np.random.default_rng(10)
+        if len(vectors) > IvfIndex.KMEANS_SAMPLE_SIZE:
+            vectors = vectors[random.choice(len(vectors), IvfIndex.KMEANS_SAMPLE_SIZE, replace=False)]
+
+        centroids = vectors[random.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(IvfIndex.KMEANS_ITERATIONS):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+
+            # empty lists keep their previous centroid
+            non_empty = norms[:, 0] > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+
+        return centroids.astype(np.float32)
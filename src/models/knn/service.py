@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import defaultdict
+
+from src import MODELS_DIR
+from src.models.knn.index import IvfIndex
+from src.models.scibert.biencoder import TemplateEmbeddingPredictor
+from src.util.io import Reader
+
+__INDEX_PATH__ = os.path.join(MODELS_DIR, 'knn')
+__K__ = 10
+# None scans the number of lists tuned when the index was built, see ``IvfIndex.tune``
+__N_PROBE__ = None
+__COMPACTION_RATIO__ = 0.1
+
+index = None
+lock = threading.Lock()
+
+
+def get_index():
+    global index
+
+    with lock:
+        if index is None:
+            index = IvfIndex(__INDEX_PATH__)
+
+    return index
+
+
+def create_index(training_set_path):
+    """
+    Embeds the templated papers of the training set and stores them in a new ANN index.
+
+    :param training_set_path: must point to a dataset with an entailments list.
+    """
+    global index
+
+    papers = group_templated_papers(training_set_path)
+    vectors = TemplateEmbeddingPredictor.get_instance().encode([paper['text'] for paper in papers])
+    index = IvfIndex.create(__INDEX_PATH__, vectors, k=__K__, labels=[{
+        'paper_id': paper['paper_id'],
+        'template_ids': paper['template_ids']
+    } for paper in papers])
+
+    print('model stored in {}'.format(__INDEX_PATH__))
+
+    return {
+        'n_papers': len(papers),
+        'n_lists': len(index.centroids),
+        'n_probe': index.meta['n_probe'],
+        'recall@{}'.format(__K__): index.meta['recall']
+    }
+
+
+def insert(papers):
+    """
+    Adds newly templated papers to the existing index.
+
+    :param papers: list of dicts with ``paper_id``, ``text`` and ``template_ids``.
+    """
+    vectors = TemplateEmbeddingPredictor.get_instance().encode([paper['text'] for paper in papers])
+    get_index().insert(vectors, [{
+        'paper_id': paper['paper_id'],
+        'template_ids': paper['template_ids']
+    } for paper in papers])
+
+    # appended papers are slower to scan, regroup them once they make up a noticeable share of the index.
+    n_compacted = get_index().meta['n_compacted']
+    if len(get_index().labels) - n_compacted > __COMPACTION_RATIO__ * n_compacted:
+        get_index().compact()
+        get_index().tune(__K__)
+
+    return {
+        'n_inserted': len(papers),
+        'n_papers': len(get_index().labels)
+    }
+
+
+def update_index(training_set_path):
+    """
+    Inserts the templated papers of the training set that are not indexed yet and updates the templates of the
+    indexed ones, as given by the training set.
+    """
+    rows = {label['paper_id']: i for i, label in enumerate(get_index().labels)}
+    papers = group_templated_papers(training_set_path)
+
+    labels = {}
+    for paper in papers:
+        row = rows.get(paper['paper_id'])
+        if row is not None and sorted(get_index().labels[row]['template_ids']) != sorted(paper['template_ids']):
+            labels[row] = {
+                'paper_id': paper['paper_id'],
+                'template_ids': paper['template_ids']
+            }
+
+    if labels:
+        get_index().update_labels(labels)
+
+    papers = [paper for paper in papers if paper['paper_id'] not in rows]
+    if not papers:
+        return {
+            'n_inserted': 0,
+            'n_updated': len(labels),
+            'n_papers': len(rows)
+        }
+
+    return dict(insert(papers), n_updated=len(labels))
+
+
+def measure_recall(queries):
+    """
+    :return: the recall@``__K__`` of the index against exact search for the ``queries`` texts.
+    """
+    vectors = TemplateEmbeddingPredictor.get_instance().encode(queries)
+
+    return get_index().recall(vectors, k=__K__, n_probe=__N_PROBE__)
+
+
+def query(q, top_k=5):
+    """
+    Recommends the templates of the ``__K__`` nearest templated papers, weighted by their similarity to ``q``.
+    """
+    vector = TemplateEmbeddingPredictor.get_instance().encode([q])[0]
+    neighbours = get_index().search(vector, k=__K__, n_probe=__N_PROBE__)
+
+    votes = defaultdict(float)
+    for similarity, paper in neighbours:
+        for template_id in paper['template_ids']:
+            votes[template_id] += similarity
+
+    votes = sorted(votes.items(), key=lambda vote: vote[1], reverse=True)
+
+    return [{'template_id': template_id, 'score': score} for template_id, score in votes[:top_k]]
+
+
+def group_templated_papers(training_set_path):
+    data = Reader.read_json(training_set_path)
+
+    papers = {}
+    for instance in data['entailments']:
+        if instance['paper_id'] not in papers:
+            papers[instance['paper_id']] = {
+                'paper_id': instance['paper_id'],
+                'text': instance['hypothesis'],
+                'template_ids': []
+            }
+
+        if instance['template_id'] not in papers[instance['paper_id']]['template_ids']:
+            papers[instance['paper_id']]['template_ids'].append(instance['template_id'])
+
+    return list(papers.values())
@@ -1,106 +1,397 @@
+import asyncio
+import json
+import sys
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-import src.models.elasticsearch.service as es
-import src.models.baseline.service as baseline
-from src.models.scibert.service import TemplateSimilarityPredictor
+from src.models import registry
+from src.util.cache import QueryCache, cached
+from src.util.io import Reader
+from src.util.lazy import lazy_import
+
+es = lazy_import('src.models.elasticsearch.service')
+bm25 = lazy_import('src.models.bm25.service')
+baseline = lazy_import('src.models.baseline.service')
+knn = lazy_import('src.models.knn.service')
+scibert = lazy_import('src.models.scibert.service')
+batching = lazy_import('src.models.scibert.batching')
+biencoder = lazy_import('src.models.scibert.biencoder')
+cascade = lazy_import('src.models.scibert.cascade')
+pool = lazy_import('src.models.scibert.pool')
+workers = lazy_import('src.models.scibert.workers')
+
+cache = QueryCache()
 
 
 def parse_args():
     parser = ArgumentParser()
 
     parser.add_argument('-a', '--approach',
-                        choices=['elasticsearch', 'scibert', 'baseline', 'baseline_full'],
+                        choices=list(registry.APPROACHES.keys()),
                         required=True,
-                        help='Indicates the approach to evaluate.'
+                        help='Indicates the approach to predict.'
                         )
 
+    add_arguments(parser)
+    registry.add_arguments(parser, registry.peek('-a', '--approach'))
+    return parser.parse_args()
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the predict task. The ones of the approaches are added by the registry.
+    """
     parser.add_argument('-q', '--query',
                         type=str,
-                        required=True,
+                        required=False,
                         help='Paper textual representation. A concatenation of paper\'s title and DOI. '
                         )
 
+    parser.add_argument('-i', '--input_path',
+                        type=str,
+                        required=False,
+                        help='JSON Lines file of queries, or - for stdin. Each line is an object with a "q" and '
+                             'optionally a "research_field". Replaces --query.'
+                        )
+
+    parser.add_argument('-o', '--output_path',
+                        type=str,
+                        default='-',
+                        required=False,
+                        help='JSON Lines file the results of --input_path are written to, or - for stdout.'
+                        )
+
+    parser.add_argument('--in_flight',
+                        type=int,
+                        default=8,
+                        required=False,
+                        help='Number of queries from --input_path that are predicted concurrently.'
+                        )
+
     parser.add_argument('-n', '--n_results',
                         type=int,
                         default=20,
                         required=False,
                         help='Number of results to be retrieved.'
                         )
-    return parser.parse_args()
 
+    parser.add_argument('-rf', '--research_field',
+                        type=str,
+                        required=False,
+                        help='Research field ID of the query paper. Used by elasticsearch and the first stage of '
+                             'scibert_cascade.'
+                        )
+
+    add_cache_arguments(parser)
 
-def predict_elasticsearch(q, n_results=20):
-    results = []
-    similar_templates = es.query_index(q, top_k=n_results)
 
-    if not similar_templates:
-        return results
+def add_cache_arguments(parser):
+    """
+    Adds the command line arguments of the result cache, which the predict and serve tasks share.
+    """
+    parser.add_argument('--cache_path',
+                        type=str,
+                        required=False,
+                        help='Path to a sqlite file that persists the elasticsearch and scibert results across runs.'
+                        )
+
+
+@cached(cache, 'elasticsearch', lambda: es.get_index_version())
+def predict_elasticsearch(q, n_results=20, research_field=None):
+    """
+    :param research_field: research field ID of the query paper, restricts the search to its research field.
+    """
+    similar_templates = es.query_index(q, top_k=n_results, research_field=research_field)
+
+    return collect_elasticsearch_results(similar_templates)
+
+
+async def predict_elasticsearch_async(q, n_results=20, research_field=None):
+    """
+    Same as ``predict_elasticsearch`` with the asynchronous client, sharing its cache entries.
+    The cache is read and written in the default executor, so that its file I/O does not block the event loop.
+    """
+    key = QueryCache.make_key(q, 'elasticsearch', await es.get_index_version_async(), n_results=n_results,
+                              research_field=research_field)
+
+    loop = asyncio.get_event_loop()
+    results = await loop.run_in_executor(None, cache.get, key)
+    if results is None:
+        results = collect_elasticsearch_results(
+            await es.query_index_async(q, top_k=n_results, research_field=research_field))
+        await loop.run_in_executor(None, cache.set, key, results)
+
+    return results
+
+
+def predict_elasticsearch_many(queries, n_results=20, research_fields=None):
+    """
+    Predicts many queries at once with the ``_msearch`` API. Cached queries are not sent again.
 
-    template_ids = []
-    for similar_template, similar_score in similar_templates.items():
+    :param research_fields: research field IDs aligned with ``queries``, see ``predict_elasticsearch``.
+    :return: list of the ``predict_elasticsearch`` results aligned with ``queries``.
+    """
+    research_fields = research_fields or [None] * len(queries)
+    version = es.get_index_version()
+    keys = [QueryCache.make_key(q, 'elasticsearch', version, n_results=n_results,
+                                research_field=research_field) for q, research_field in zip(queries, research_fields)]
+    results = [cache.get(key) for key in keys]
 
-        if 'x' in similar_template:
-            template_id = similar_template[:similar_template.find('x')]
-        else:
-            template_id = None
+    missing = [i for i, result in enumerate(results) if result is None]
+    similar_templates = es.query_index_many([queries[i] for i in missing], top_k=n_results,
+                                            research_fields=[research_fields[i] for i in missing])
 
-        if template_id not in template_ids:
-            results.append({
-                'template_id': template_id,
-                'score': similar_score
-            })
-            template_ids.append(template_id)
+    for i, similar in zip(missing, similar_templates):
+        results[i] = collect_elasticsearch_results(similar)
+        cache.set(keys[i], results[i])
 
-    return results[:n_results]
+    return results
 
 
-def predict_scibert(q, n_results=20):
-    predictor = TemplateSimilarityPredictor.get_instance()
+def collect_elasticsearch_results(similar_templates):
+    return [{
+        'template_id': template_id,
+        'score': score
+    } for template_id, score in similar_templates.items()]
+
+
+def predict_bm25(q, n_results=20):
+    similar_templates = bm25.query_index(q, top_k=n_results)
+
+    return collect_elasticsearch_results(similar_templates)
+
+
+@cached(cache, 'scibert', lambda: scibert.TemplateSimilarityPredictor.version(), ignore=('micro_batching',))
+def predict_scibert(q, n_results=20, micro_batching=False):
+    """
+    :param micro_batching: if True, the query is scored together with concurrent queries
+        by the shared ``MicroBatcher`` instead of running its own forward passes.
+        Otherwise it is scored by the ``WorkerPool`` if worker processes are configured,
+        or by a replica of the thread-safe ``PredictorPool``.
+    """
+    if micro_batching:
+        predictor = batching.MicroBatcher.get_instance()
+    elif workers.WorkerPool.N_WORKERS:
+        predictor = workers.WorkerPool.get_instance()
+    else:
+        predictor = pool.PredictorPool.get_instance()
+
     similar_templates = predictor.predict_similar_templates(q)
 
     return similar_templates[:n_results]
 
 
+def predict_scibert_cascade(q, n_results=20, research_field=None):
+    """
+    Scores only the templates shortlisted by the ``TemplateCandidateSelector`` with the SciBERT predictor.
+
+    :param research_field: research field ID of the query paper, used by the first stage if provided.
+    """
+    with pool.PredictorPool.get_instance().acquire() as predictor:
+        templates = predictor.load_premises()['templates']
+
+        candidates = cascade.TemplateCandidateSelector.get_instance().select(q, templates, research_field)
+        if not candidates:
+            return []
+
+        similar_templates = predictor.predict_similar_templates(q, template_ids=candidates)
+
+    return similar_templates[:n_results]
+
+
+def predict_scibert_biencoder(q, n_results=20):
+    predictor = biencoder.TemplateEmbeddingPredictor.get_instance()
+    similar_templates = predictor.predict_similar_templates(q, n_results)
+
+    return similar_templates[:n_results]
+
+
+def predict_scibert_knn(q, n_results=20):
+    return knn.query(q, top_k=n_results)
+
+
 def predict_baseline(q, n_results=20):
     similar_templates = baseline.query(q)
 
-    results = []
-    for template in similar_templates:
-        results.append({
-            'template_id': template
-        })
-
-    return results[:n_results]
+    return collect_baseline_results(similar_templates, n_results)
 
 
 def predict_baseline_full(q, n_results=20):
     similar_templates = baseline.query(q, full=True)
 
-    results = []
-    for template in similar_templates:
-        results.append({
-            'template_id': template
-        })
+    return collect_baseline_results(similar_templates, n_results)
+
+
+def predict_baseline_many(queries, n_results=20, full=False):
+    """
+    :return: list of the ``predict_baseline`` or ``predict_baseline_full`` results aligned with ``queries``.
+    """
+    return [collect_baseline_results(similar_templates, n_results)
+            for similar_templates in baseline.query_many(queries, full=full)]
+
+
+def collect_baseline_results(similar_templates, n_results=20):
+    return [{
+        'template_id': template
+    } for template in similar_templates[:n_results]]
+
+
+def predict(approach, q, n_results=20, research_field=None, micro_batching=False):
+    """
+    Recommends templates for ``q`` with ``approach``.
+
+    :param research_field: research field ID of the query paper, used by elasticsearch and scibert_cascade
+        if provided.
+    :param micro_batching: passed to ``predict_scibert``.
+    """
+    return {
+        'elasticsearch': partial(predict_elasticsearch, research_field=research_field),
+        'bm25': predict_bm25,
+        'scibert': partial(predict_scibert, micro_batching=micro_batching),
+        'scibert_cascade': partial(predict_scibert_cascade, research_field=research_field),
+        'scibert_biencoder': predict_scibert_biencoder,
+        'scibert_knn': predict_scibert_knn,
+        'baseline': predict_baseline,
+        'baseline_full': predict_baseline_full
+    }[approach](q, n_results)
+
+
+def predict_stream(approach, lines, output, n_results=20, in_flight=8):
+    """
+    Predicts a stream of JSON lines and writes one JSON line per query to ``output``, in the input order.
+    At most ``in_flight`` batches of queries are predicted concurrently, so memory is bounded for inputs of any size.
+    Elasticsearch queries are sent in batches of one ``_msearch`` request. Concurrent scibert queries are scored
+    in shared batches by the ``MicroBatcher``, unless worker processes are configured.
+
+    :param lines: iterable of JSON objects with a ``q`` and optionally a ``research_field``. Their other keys,
+        e.g. an ID, are copied to the output line. A line that is not a JSON object is answered with an error.
+    :return: the number of predicted queries and of the ones that failed.
+    """
+    micro_batching = approach == 'scibert' and not workers.WorkerPool.N_WORKERS
+    batch_size = es.__MSEARCH_SIZE__ if approach == 'elasticsearch' else 1
+    n_queries = 0
+    n_failed = 0
+
+    def write(batch, future):
+        try:
+            results = iter(future.result())
+            error = None
+        except Exception as e:
+            results = None
+            error = str(e)
+
+        n_batch_failed = 0
+        for instance in batch:
+            if not instance.get('q'):
+                instance.setdefault('error', 'q must be provided.')
+            elif error is not None:
+                instance['error'] = error
+            else:
+                instance['results'] = next(results)
+
+            output.write(json.dumps(instance) + '\n')
+            n_batch_failed += 'error' in instance
+
+        return n_batch_failed
 
-    return results[:n_results]
+    with ThreadPoolExecutor(in_flight) as executor:
+        pending = deque()
+
+        for batch in iterate_batches(map(decode_instance, lines), batch_size):
+            pending.append((batch, executor.submit(predict_batch, approach, batch, n_results, micro_batching)))
+            n_queries += len(batch)
+
+            if len(pending) >= in_flight:
+                n_failed += write(*pending.popleft())
+
+        while pending:
+            n_failed += write(*pending.popleft())
+
+    output.flush()
+
+    return {
+        'n_queries': n_queries,
+        'n_failed': n_failed
+    }
+
+
+def decode_instance(line):
+    """
+    :return: the query object of a JSON line, or an object with the ``error`` of a line that is not one.
+    """
+    try:
+        instance = json.loads(line)
+    except ValueError as e:
+        return {'error': 'invalid JSON: {}'.format(e)}
+
+    if not isinstance(instance, dict):
+        return {'error': 'each line must be a JSON object.'}
+
+    return instance
+
+
+def predict_batch(approach, instances, n_results=20, micro_batching=False):
+    """
+    :return: the results of the instances that have a ``q``, in their order.
+    """
+    instances = [instance for instance in instances if instance.get('q')]
+
+    if approach == 'elasticsearch':
+        return predict_elasticsearch_many([instance['q'] for instance in instances], n_results,
+                                          [instance.get('research_field') for instance in instances])
+
+    return [predict(approach, instance['q'], n_results, instance.get('research_field'), micro_batching)
+            for instance in instances]
+
+
+def iterate_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
 
 
 def main(config=None):
     args = config or parse_args()
 
     assert args.approach, 'approach must be provided.'
-    assert args.query, 'query must be provided.'
+    assert args.query or args.input_path, 'query or input_path must be provided.'
     assert args.n_results, 'n_results must be provided'
 
+    registry.configure(args.approach, args)
+
+    if args.cache_path:
+        cache.open(args.cache_path)
+
+    if args.input_path:
+        # the results may be streamed to stdout, so the progress goes to stderr
+        print('Querying {}...'.format(args.input_path), file=sys.stderr)
+        output = sys.stdout if args.output_path == '-' else open(args.output_path, 'w', encoding='utf-8')
+
+        try:
+            report = predict_stream(args.approach, Reader.iterate_lines(args.input_path), output,
+                                    args.n_results, args.in_flight)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        report['cache'] = cache.stats()
+        print(report, file=sys.stderr)
+        return
+
     print('Querying...')
-    results = {
-        'elasticsearch': predict_elasticsearch,
-        'scibert': predict_scibert,
-        'baseline': predict_baseline,
-        'baseline_full': predict_baseline_full
-    }[args.approach](args.query, args.n_results)
+    results = predict(args.approach, args.query, args.n_results, args.research_field)
 
     print(results)
+    print('cache: {}'.format(cache.stats()))
 
 
 if __name__ == '__main__':
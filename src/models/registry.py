@@ -0,0 +1,81 @@
+import importlib
+import itertools
+import sys
+
+# Approaches and the backend modules they need. The modules are only imported once their approach is selected.
+APPROACHES = {
+    'elasticsearch': ['src.models.elasticsearch.service'],
+    'bm25': ['src.models.bm25.service'],
+    'scibert': ['src.models.scibert.service', 'src.models.scibert.pool', 'src.models.scibert.batching',
+                'src.models.scibert.workers'],
+    'scibert_cascade': ['src.models.scibert.service', 'src.models.scibert.pool', 'src.models.scibert.cascade'],
+    'scibert_biencoder': ['src.models.scibert.service', 'src.models.scibert.biencoder'],
+    'scibert_knn': ['src.models.scibert.biencoder', 'src.models.knn.service'],
+    'baseline': ['src.models.baseline.service'],
+    'baseline_full': ['src.models.baseline.service']
+}
+
+TASKS = {
+    'dataset': 'src.data.main',
+    'train': 'src.models.train',
+    'evaluate': 'src.models.evaluate',
+    'predict': 'src.models.predict',
+    'serve': 'src.models.serve'
+}
+
+
+def load(approach):
+    """
+    Imports the backend modules of ``approach``.
+    """
+    if approach not in APPROACHES:
+        raise ValueError('Unknown approach {}. Choose one of {}'.format(approach, list(APPROACHES.keys())))
+
+    return [importlib.import_module(module_name) for module_name in APPROACHES[approach]]
+
+
+def configure(approach, config):
+    """
+    Imports the backend modules of ``approach`` and passes the command line arguments to the ones that
+    define a ``configure`` function.
+    """
+    for module in load(approach):
+        if hasattr(module, 'configure'):
+            module.configure(config)
+
+
+def add_arguments(parser, approaches):
+    """
+    Imports the backend modules of ``approaches`` and lets the ones that define an ``add_arguments`` function add
+    their command line arguments to ``parser``. Without approaches, e.g. for --help, the arguments of all of them
+    are added. Unknown approaches are left to the parser to report.
+    """
+    modules = []
+    for approach in approaches or APPROACHES.keys():
+        if approach in APPROACHES:
+            modules += [module for module in load(approach) if module not in modules]
+
+    for module in modules:
+        if hasattr(module, 'add_arguments'):
+            module.add_arguments(parser)
+
+
+def peek(*option_strings):
+    """
+    Returns the values passed with ``option_strings`` on the command line before the whole parser is built, so
+    that only the arguments of the selected task and approaches have to be added to it. Only exact option strings
+    are matched, -trainp must not be read as -t rainp.
+    """
+    values = []
+    arguments = sys.argv[1:]
+    for i, argument in enumerate(arguments):
+        name, _, value = argument.partition('=')
+        if name in option_strings:
+            values = [value] if value else \
+                list(itertools.takewhile(lambda next_argument: not next_argument.startswith('-'), arguments[i + 1:]))
+
+    return values
+
+
+def run_task(task, config):
+    return importlib.import_module(TASKS[task]).main(config)
@@ -0,0 +1,224 @@
+import contextlib
+import functools
+import os
+import threading
+
+import torch
+import torch.nn as nn
+from transformers import BertConfig, BertForSequenceClassification, BertPreTrainedModel
+
+from src.util.cache import directory_signature
+
+ONNX_FILE_NAME = 'model.onnx'
+SAFETENSORS_FILE_NAME = 'model.safetensors'
+PRECISIONS = ['fp32', 'int8', 'bf16']
+PRECISION_FILE_NAMES = {
+    'int8': 'pytorch_model_int8.bin',
+    'bf16': 'pytorch_model_bf16.bin'
+}
+INIT_FUNCTION_NAMES = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'kaiming_uniform_',
+                       'kaiming_normal_', 'xavier_uniform_', 'xavier_normal_']
+
+# threads that are within ``skip_init``
+skipping_init = threading.local()
+
+
+class TorchBackend:
+    """
+    Runs the NLI model with eager PyTorch.
+
+    Besides ``fp32``, the model can run with dynamically quantized int8 Linear layers (``int8``) or with bf16
+    weights and autocast (``bf16``). Reduced-precision weights are stored next to the checkpoint the first time
+    they are created, so that later starts load them directly. They are recreated once the checkpoint changes.
+    """
+
+    def __init__(self, model_path, precision='fp32'):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision {}. Choose one of {}'.format(precision, PRECISIONS))
+
+        if precision == 'bf16' and not Utils.cpu_supports_bf16():
+            print('bf16 is not supported by this CPU, falling back to fp32.')
+            precision = 'fp32'
+
+        self.precision = precision
+
+        if precision == 'fp32':
+            self.model = load_model(model_path)
+        else:
+            self.model = TorchBackend.load_reduced_precision(model_path, precision)
+
+        self.model.eval()
+
+    def __call__(self, sequence_tokens, attention_mask, token_type):
+        with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.precision == 'bf16'):
+            return self.model(sequence_tokens, attention_mask, token_type).logits.float()
+
+    @staticmethod
+    def load_reduced_precision(model_path, precision):
+        artifact_path = os.path.join(model_path, PRECISION_FILE_NAMES[precision])
+        # the version of the checkpoint the artifact was converted from, without the derived files
+        source = directory_signature(model_path, exclude=[ONNX_FILE_NAME] + list(PRECISION_FILE_NAMES.values()))
+
+        artifact = torch.load(artifact_path) if os.path.exists(artifact_path) else None
+        if artifact is not None and artifact.get('source') != source:
+            print('{} was converted from another checkpoint, recreating it.'.format(artifact_path))
+            artifact = None
+
+        if artifact is None:
+            model = TorchBackend.convert(load_model(model_path), precision)
+            torch.save({'source': source, 'state_dict': model.state_dict()}, artifact_path)
+            print('{} model stored in {}'.format(precision, artifact_path))
+            return model
+
+        # the architecture is built from the config only, the weights come from the stored artifact.
+        with skip_init():
+            model = BertForSequenceClassification(BertConfig.from_pretrained(model_path, local_files_only=True))
+
+        model = TorchBackend.convert(model, precision)
+        model.load_state_dict(artifact['state_dict'])
+        return model
+
+    @staticmethod
+    def convert(model, precision):
+        if precision == 'int8':
+            return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+        return model.to(torch.bfloat16)
+
+
+class OnnxBackend:
+    """
+    Runs the exported NLI graph (see ``src.models.scibert.export``) with ONNX Runtime's CPU execution provider.
+    """
+
+    def __init__(self, model_path):
+        import onnxruntime
+
+        onnx_path = os.path.join(model_path, ONNX_FILE_NAME)
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError('{} does not exist. Export it first with: '
+                                    'python -m src.models.scibert.export'.format(onnx_path))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, sequence_tokens, attention_mask, token_type):
+        logits = self.session.run(['logits'], {
+            'input_ids': sequence_tokens.numpy(),
+            'attention_mask': attention_mask.numpy(),
+            'token_type_ids': token_type.numpy()
+        })[0]
+
+        return torch.from_numpy(logits)
+
+
+def load_model(model_path):
+    """
+    Loads the fp32 NLI model from a model bundle (see ``src.models.scibert.bundle``) or from a checkpoint in the
+    ``transformers.PretrainedModel`` format.
+
+    The weights of a bundle are memory-mapped from its safetensors file and used in place, so processes loading
+    the same bundle share them through the page cache.
+    """
+    safetensors_path = os.path.join(model_path, SAFETENSORS_FILE_NAME)
+    if not os.path.exists(safetensors_path):
+        return BertForSequenceClassification.from_pretrained(model_path)
+
+    from safetensors.torch import load_file
+
+    with skip_init():
+        model = BertForSequenceClassification(BertConfig.from_pretrained(model_path, local_files_only=True))
+    state_dict = load_file(safetensors_path)
+
+    missing = set(model.state_dict().keys()) - set(state_dict.keys())
+    if missing:
+        raise ValueError('{} misses the weights {}'.format(safetensors_path, sorted(missing)))
+
+    for name, tensor in state_dict.items():
+        module_name, _, attribute = name.rpartition('.')
+        module = model.get_submodule(module_name)
+
+        if attribute in module._parameters:
+            module._parameters[attribute] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attribute] = tensor
+
+    return model
+
+
+@contextlib.contextmanager
+def skip_init():
+    """
+    Skips the random initialization of the modules created by the current thread within, because their parameters
+    are replaced right after. Covers the ``_init_weights`` of transformers and the ``torch.nn.init`` functions
+    called by the ``reset_parameters`` of the torch modules, which leaves the parameters uninitialized. Modules
+    created by other threads meanwhile are initialized as usual.
+    """
+    skipping_init.enabled = True
+    try:
+        yield
+    finally:
+        skipping_init.enabled = False
+
+
+def skippable(function):
+    """
+    Wraps an initialization function so that it returns its first argument untouched within ``skip_init``.
+    """
+    @functools.wraps(function)
+    def wrapper(tensor, *args, **kwargs):
+        if getattr(skipping_init, 'enabled', False):
+            return tensor
+
+        return function(tensor, *args, **kwargs)
+
+    return wrapper
+
+
+# the wrappers are installed once, a thread outside of ``skip_init`` runs the original functions.
+for name in INIT_FUNCTION_NAMES:
+    if hasattr(nn.init, name):
+        setattr(nn.init, name, skippable(getattr(nn.init, name)))
+
+BertPreTrainedModel._init_weights = skippable(BertPreTrainedModel._init_weights)
+
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'onnx': OnnxBackend
+}
+
+
+def create_backend(name, model_path, precision='fp32'):
+    """
+    :param name: one of ``BACKENDS``.
+    :param model_path: directory of the NLI model in the ``transformers.PretrainedModel`` format.
+    :param precision: one of ``PRECISIONS``. Only supported by the torch backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend {}. Choose one of {}'.format(name, list(BACKENDS.keys())))
+
+    if name == 'torch':
+        return TorchBackend(model_path, precision)
+
+    if precision != 'fp32':
+        raise ValueError('The {} backend only supports fp32.'.format(name))
+
+    return BACKENDS[name](model_path)
+
+
+class Utils:
+
+    @staticmethod
+    def cpu_supports_bf16():
+        """
+        bf16 matmuls are only fast on CPUs with native bf16 instructions (AVX512-BF16 or AMX).
+        """
+        try:
+            with open('/proc/cpuinfo') as f:
+                flags = f.read()
+        except OSError:
+            return False
+
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
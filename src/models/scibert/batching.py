@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+from src.models.scibert.service import TemplateSimilarityPredictor
+
+
+class MicroBatcher:
+    """
+    Collects (premise, hypothesis) pairs from concurrent callers and scores them together.
+
+    A batch is flushed as one model call as soon as it holds ``max_batch_size`` pairs or
+    its oldest pair has waited ``max_wait_ms`` milliseconds. Each caller only receives
+    the scores of the pairs it submitted.
+    """
+    __instance = None
+    __lock = threading.Lock()
+    MAX_BATCH_SIZE = 32
+    MAX_WAIT_MS = 5
+
+    def __init__(self, predictor, max_batch_size=None, max_wait_ms=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size or MicroBatcher.MAX_BATCH_SIZE
+        self.max_wait_ms = MicroBatcher.MAX_WAIT_MS if max_wait_ms is None else max_wait_ms
+        self.queue = Queue()
+
+        self.worker = threading.Thread(target=self._run, name='scibert-micro-batcher', daemon=True)
+        self.worker.start()
+
+    @staticmethod
+    def get_instance():
+        with MicroBatcher.__lock:
+            if MicroBatcher.__instance is None:
+                MicroBatcher.__instance = MicroBatcher(TemplateSimilarityPredictor.get_instance())
+
+        return MicroBatcher.__instance
+
+    def submit(self, pairs):
+        """
+        :param pairs: list of (template_string, paper_string) tuples.
+        :return: list of futures resolving to (label, score) tuples.
+        """
+        futures = []
+        for pair in pairs:
+            future = Future()
+            self.queue.put((pair, future))
+            futures.append(future)
+
+        return futures
+
+    def predict_pairs(self, pairs):
+        return [future.result() for future in self.submit(pairs)]
+
+    def predict_similar_templates(self, q):
+        templates = self.predictor.load_premises()['templates']
+
+        pairs = [(template['premise'], q) for template in templates]
+        predictions = self.predict_pairs(pairs)
+
+        return TemplateSimilarityPredictor.collect_similar_templates(templates, predictions)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        pairs = [pair for pair, _ in batch]
+
+        try:
+            predictions = self.predictor.predict_pairs(pairs, batch_size=len(pairs))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert micro-batching.
+    """
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=MicroBatcher.MAX_BATCH_SIZE,
+                        required=False,
+                        help='Maximum number of (premise, query) pairs the scibert approach scores in one forward '
+                             'pass when queries are streamed from --input_path or served with --micro_batching.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert micro-batching.
+    """
+    MicroBatcher.MAX_BATCH_SIZE = getattr(config, 'batch_size', None) or MicroBatcher.MAX_BATCH_SIZE
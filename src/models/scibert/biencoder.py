@@ -0,0 +1,142 @@
+import os
+import threading
+
+import numpy as np
+import torch
+
+from src.models.scibert.backends import load_model
+from src.models.scibert.service import TemplateSimilarityPredictor, Utils
+from src.util.io import Reader, Writer
+
+
+class TemplateEmbeddingPredictor:
+    """
+    Bi-encoder variant of the SciBERT approach. Every template premise is encoded once into a dense vector,
+    so that a query only costs one encoder pass and a matrix-vector product, independent of the number of templates.
+    """
+    __instance = None
+    __lock = threading.Lock()
+    EMBEDDINGS_PATH = os.path.join(TemplateSimilarityPredictor.BERT_NLI_PATH, 'premises_embeddings.npy')
+    EMBEDDINGS_TEMPLATES_PATH = os.path.join(TemplateSimilarityPredictor.BERT_NLI_PATH, 'premises_embeddings.json')
+    BATCH_SIZE = 8
+    RERANK_TOP_K = 0
+
+    def __init__(self):
+        self.bert_tokenizer = TemplateSimilarityPredictor.load_tokenizer()
+        self.bert_model = load_model(TemplateSimilarityPredictor.model_path()).bert
+        self.bert_model.eval()
+        # (embeddings, templates), replaced as a whole so that concurrent queries never see only one of them
+        self.premises = None
+        self.premises_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        with TemplateEmbeddingPredictor.__lock:
+            if TemplateEmbeddingPredictor.__instance is None:
+                TemplateEmbeddingPredictor.__instance = TemplateEmbeddingPredictor()
+
+        return TemplateEmbeddingPredictor.__instance
+
+    def create_embeddings(self, premises_path):
+        """
+        Encodes the premises of ``premises_path`` and stores them as a float32 matrix next to the model.
+        """
+        templates = Reader.read_json(premises_path)['templates']
+        embeddings = self.encode([template['premise'] for template in templates])
+
+        np.save(TemplateEmbeddingPredictor.EMBEDDINGS_PATH, embeddings)
+        Writer.write_json({
+            'templates': [{'id': template['id'], 'label': template['label']} for template in templates]
+        }, TemplateEmbeddingPredictor.EMBEDDINGS_TEMPLATES_PATH)
+
+        print('embeddings stored in {}'.format(TemplateEmbeddingPredictor.EMBEDDINGS_PATH))
+        self.premises = None
+
+        return {
+            'n_templates': len(templates),
+            'dimension': embeddings.shape[1]
+        }
+
+    def load_embeddings(self):
+        """
+        :return: the premise embeddings and the templates of their rows.
+        """
+        with self.premises_lock:
+            if self.premises is None:
+                embeddings = np.load(TemplateEmbeddingPredictor.EMBEDDINGS_PATH, mmap_mode='r')
+                templates = Reader.read_json(TemplateEmbeddingPredictor.EMBEDDINGS_TEMPLATES_PATH)['templates']
+                self.premises = (embeddings, templates)
+
+        return self.premises
+
+    def predict_similar_templates(self, q, n_results=20):
+        embeddings, templates = self.load_embeddings()
+        scores = embeddings @ self.encode([q])[0]
+
+        if not len(scores):
+            return []
+
+        n_results = max(1, min(n_results, len(scores)))
+        top_k = np.argpartition(-scores, n_results - 1)[:n_results]
+        top_k = top_k[np.argsort(-scores[top_k])]
+
+        similar_templates = [{
+            'template_id': templates[i]['id'],
+            'label': templates[i]['label'],
+            'score': float(scores[i])
+        } for i in top_k]
+
+        if TemplateEmbeddingPredictor.RERANK_TOP_K:
+            template_ids = [template['template_id'] for template in
+                            similar_templates[:TemplateEmbeddingPredictor.RERANK_TOP_K]]
+            return TemplateSimilarityPredictor.get_instance().predict_similar_templates(q, template_ids=template_ids)
+
+        return similar_templates
+
+    def encode(self, strings):
+        """
+        :return: L2-normalized mean-pooled embeddings as a float32 matrix with one row per string.
+        """
+        embeddings = []
+
+        for i in range(0, len(strings), TemplateEmbeddingPredictor.BATCH_SIZE):
+            sequences = []
+            for string in strings[i:i + TemplateEmbeddingPredictor.BATCH_SIZE]:
+                tokens = self.bert_tokenizer.tokenize(Utils.post_process(string) or '')
+                tokens = ['[CLS]'] + tokens[:TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH - 2] + ['[SEP]']
+                sequence_tokens = self.bert_tokenizer.convert_tokens_to_ids(tokens)
+                sequences.append((sequence_tokens, [0] * len(sequence_tokens), Utils.get_attention_mask(tokens)))
+
+            sequence_tokens, token_type, attention_mask = Utils.pad(sequences, self.bert_tokenizer.pad_token_id)
+            attention_mask = torch.tensor(attention_mask)
+
+            with torch.inference_mode():
+                hidden_states = self.bert_model(torch.tensor(sequence_tokens), attention_mask,
+                                                torch.tensor(token_type)).last_hidden_state
+
+            mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings.append(torch.nn.functional.normalize(pooled, dim=-1).numpy())
+
+        return np.concatenate(embeddings).astype(np.float32)
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert_biencoder approach.
+    """
+    parser.add_argument('--rerank_top_k',
+                        type=int,
+                        default=TemplateEmbeddingPredictor.RERANK_TOP_K,
+                        required=False,
+                        help='Number of scibert_biencoder results re-ranked by the SciBERT cross-encoder. '
+                             '0 disables re-ranking.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert_biencoder approach.
+    """
+    if getattr(config, 'rerank_top_k', None) is not None:
+        TemplateEmbeddingPredictor.RERANK_TOP_K = config.rerank_top_k
@@ -0,0 +1,65 @@
+import os
+from argparse import ArgumentParser
+
+from transformers import BertForSequenceClassification, BertTokenizer
+
+from src.models.scibert.backends import SAFETENSORS_FILE_NAME
+from src.models.scibert.service import TemplateSimilarityPredictor
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-m', '--model_path',
+                        type=str,
+                        default=TemplateSimilarityPredictor.BERT_NLI_PATH,
+                        required=False,
+                        help='Path to the NLI model in the transformers.PretrainedModel format.'
+                        )
+
+    parser.add_argument('--tokenizer_path',
+                        type=str,
+                        default=TemplateSimilarityPredictor.BERT_TOKENIZER_PATH,
+                        required=False,
+                        help='Path or Hugging Face Hub name of the tokenizer.'
+                        )
+
+    parser.add_argument('--bundle_path',
+                        type=str,
+                        default=TemplateSimilarityPredictor.BUNDLE_PATH,
+                        required=False,
+                        help='Directory the bundle is written to.'
+                        )
+    return parser.parse_args()
+
+
+def create_bundle(model_path, tokenizer_path, bundle_path):
+    """
+    Writes the config, the tokenizer vocabulary and the safetensors weights of the NLI model to ``bundle_path``,
+    so that the service can start from this directory alone without network access.
+    """
+    from safetensors.torch import save_file
+
+    model = BertForSequenceClassification.from_pretrained(model_path)
+    tokenizer = BertTokenizer.from_pretrained(tokenizer_path)
+
+    os.makedirs(bundle_path, exist_ok=True)
+    model.config.save_pretrained(bundle_path)
+    tokenizer.save_pretrained(bundle_path)
+
+    state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    save_file(state_dict, os.path.join(bundle_path, SAFETENSORS_FILE_NAME), metadata={'format': 'pt'})
+
+    print('bundle stored in {}'.format(bundle_path))
+    return bundle_path
+
+
+def main(config=None):
+    args = config or parse_args()
+
+    print('Bundling SciBERT...')
+    create_bundle(args.model_path, args.tokenizer_path, args.bundle_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import threading
+
+import src.models.baseline.service as baseline
+from src.models.bm25.index import Bm25Index
+from src.models.elasticsearch.document import DocumentCreator
+
+
+class TemplateCandidateSelector:
+    """
+    Cheap first stage of the SciBERT cascade. It shortlists the templates that are worth scoring with the
+    cross-encoder, using the research field map of the baseline and/or BM25 over the template premises.
+    """
+    __instance = None
+    __lock = threading.Lock()
+    FIRST_STAGES = ['field', 'bm25', 'both']
+    FALLBACKS = ['all', 'none']
+    FIRST_STAGE = 'both'
+    N_CANDIDATES = 5
+    FALLBACK = 'all'
+
+    def __init__(self):
+        # (templates, in-memory Bm25Index) of the indexed premises, replaced as a whole so that concurrent queries
+        # never see a partially built index.
+        self.bm25_index = None
+
+    @staticmethod
+    def get_instance():
+        with TemplateCandidateSelector.__lock:
+            if TemplateCandidateSelector.__instance is None:
+                TemplateCandidateSelector.__instance = TemplateCandidateSelector()
+
+        return TemplateCandidateSelector.__instance
+
+    def select(self, q, templates, research_field=None):
+        """
+        :param q: paper textual representation.
+        :param templates: list of templates as stored in the premises file.
+        :param research_field: research field ID of the paper, used by the ``field`` stage.
+        :return: the IDs of at most ``N_CANDIDATES`` templates. Templates of the paper's research field come
+            first, the remaining ones are ranked by BM25. If no template qualifies, all template IDs are returned
+            with the ``all`` fallback and none with the ``none`` fallback.
+        """
+        first_stage = TemplateCandidateSelector.FIRST_STAGE
+        if first_stage not in TemplateCandidateSelector.FIRST_STAGES:
+            raise ValueError('Unknown first stage {}. Choose one of {}'.format(
+                first_stage, TemplateCandidateSelector.FIRST_STAGES))
+
+        scores = self.score(q, templates)
+        field_templates = set()
+        if first_stage in ['field', 'both'] and research_field:
+            field_templates = set(baseline.query(research_field)) - {None}
+
+        candidates = []
+        for i, template in enumerate(templates):
+            in_field = template['id'] in field_templates
+
+            if first_stage == 'field' and not in_field:
+                continue
+
+            if first_stage == 'bm25' and not scores[i]:
+                continue
+
+            if first_stage == 'both' and not in_field and not scores[i]:
+                continue
+
+            candidates.append((in_field, scores[i], template['id']))
+
+        candidates = sorted(candidates, key=lambda c: (c[0], c[1]), reverse=True)
+        candidates = [template_id for _, _, template_id in candidates[:TemplateCandidateSelector.N_CANDIDATES]]
+
+        if not candidates and TemplateCandidateSelector.FALLBACK == 'all':
+            return [template['id'] for template in templates]
+
+        return candidates
+
+    def score(self, q, templates):
+        """
+        :return: the BM25 score of every template premise for the query, aligned with ``templates``. The premises
+            are ranked like the documents of the bm25 approach.
+        """
+        bm25_index = self.bm25_index
+        if bm25_index is None or templates is not bm25_index[0]:
+            bm25_index = self.index(templates)
+
+        _, index = bm25_index
+        scores = {template_id: score
+                  for score, template_id in index.search(DocumentCreator.postprocess(q), k=len(templates))}
+
+        return [scores.get(template['id'], 0.0) for template in templates]
+
+    def index(self, templates):
+        index = Bm25Index.build({
+            'text': DocumentCreator.postprocess(template['premise']),
+            'template_id': template['id']
+        } for template in templates)
+
+        self.bm25_index = (templates, index)
+        return self.bm25_index
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert_cascade approach.
+    """
+    parser.add_argument('--first_stage',
+                        choices=TemplateCandidateSelector.FIRST_STAGES,
+                        default=TemplateCandidateSelector.FIRST_STAGE,
+                        required=False,
+                        help='Candidate retrieval of scibert_cascade. field: templates of the paper\'s research '
+                             'field. bm25: BM25 over the template premises. both: field templates first, then BM25.'
+                        )
+
+    parser.add_argument('--n_candidates',
+                        type=int,
+                        default=TemplateCandidateSelector.N_CANDIDATES,
+                        required=False,
+                        help='Number of candidate templates scored by SciBERT in scibert_cascade.'
+                        )
+
+    parser.add_argument('--fallback',
+                        choices=TemplateCandidateSelector.FALLBACKS,
+                        default=TemplateCandidateSelector.FALLBACK,
+                        required=False,
+                        help='Behaviour of scibert_cascade if the first stage finds no candidates. '
+                             'all: score all templates. none: return no results.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert_cascade approach.
+    """
+    TemplateCandidateSelector.FIRST_STAGE = getattr(config, 'first_stage', None) or TemplateCandidateSelector.FIRST_STAGE
+    TemplateCandidateSelector.N_CANDIDATES = getattr(config, 'n_candidates', None) or \
+                                             TemplateCandidateSelector.N_CANDIDATES
+    TemplateCandidateSelector.FALLBACK = getattr(config, 'fallback', None) or TemplateCandidateSelector.FALLBACK
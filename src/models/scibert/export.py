@@ -0,0 +1,125 @@
+import os
+from argparse import ArgumentParser
+
+import torch
+
+from src import PROCESSED_DATA_DIR
+from src.models.scibert.backends import ONNX_FILE_NAME, load_model
+from src.models.scibert.service import TemplateSimilarityPredictor
+from src.util.io import Reader
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-m', '--model_path',
+                        type=str,
+                        default=TemplateSimilarityPredictor.model_path(),
+                        required=False,
+                        help='Path to the NLI model directory or bundle. The ONNX graph is written next to it.'
+                        )
+
+    parser.add_argument('-testp', '--test_set_path',
+                        type=str,
+                        default=os.path.join(PROCESSED_DATA_DIR, 'test_set.json'),
+                        required=False,
+                        help='Path to the test set whose hypotheses are used to verify the exported graph.'
+                        )
+
+    parser.add_argument('--atol',
+                        type=float,
+                        default=1e-3,
+                        required=False,
+                        help='Maximum absolute difference tolerated between the PyTorch and ONNX scores.'
+                        )
+    return parser.parse_args()
+
+
+def export_onnx(model_path):
+    """
+    Exports the NLI model to ``<model_path>/model.onnx`` with dynamic batch and sequence axes.
+    """
+    model = load_model(model_path)
+    model.eval()
+
+    sample = torch.ones((2, 16), dtype=torch.long)
+    onnx_path = os.path.join(model_path, ONNX_FILE_NAME)
+    dynamic_axes = {0: 'batch', 1: 'sequence'}
+
+    torch.onnx.export(model,
+                      (sample, sample, torch.zeros_like(sample)),
+                      onnx_path,
+                      input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+                      output_names=['logits'],
+                      dynamic_axes={
+                          'input_ids': dynamic_axes,
+                          'attention_mask': dynamic_axes,
+                          'token_type_ids': dynamic_axes,
+                          'logits': {0: 'batch'}
+                      },
+                      opset_version=14,
+                      do_constant_folding=True)
+
+    print('model exported to {}'.format(onnx_path))
+    return onnx_path
+
+
+def verify_onnx(test_set_path, atol=1e-3, top_k=5):
+    """
+    Compares the ONNX backend against the PyTorch backend on the test set hypotheses.
+
+    :return: the number of verified queries, the maximum score difference and the queries whose top-k
+        templates differ.
+    """
+    torch_predictor = TemplateSimilarityPredictor(backend='torch')
+    onnx_predictor = TemplateSimilarityPredictor(backend='onnx')
+
+    test_set = Reader.read_json(test_set_path)
+    instances = test_set['entailments'] + test_set['neutrals']
+
+    templates = torch_predictor.load_premises()['templates']
+
+    max_difference = 0.0
+    mismatches = []
+    for instance in instances:
+        pairs = [(template['premise'], instance['hypothesis']) for template in templates]
+        torch_predictions = torch_predictor.predict_pairs(pairs)
+        onnx_predictions = onnx_predictor.predict_pairs(pairs)
+
+        for (_, torch_score), (_, onnx_score) in zip(torch_predictions, onnx_predictions):
+            max_difference = max(max_difference, abs(torch_score - onnx_score))
+
+        torch_results = TemplateSimilarityPredictor.collect_similar_templates(templates, torch_predictions)
+        onnx_results = TemplateSimilarityPredictor.collect_similar_templates(templates, onnx_predictions)
+        torch_ids = [result['template_id'] for result in torch_results[:top_k]]
+        onnx_ids = [result['template_id'] for result in onnx_results[:top_k]]
+        if torch_ids != onnx_ids:
+            mismatches.append(instance['instance_id'])
+
+    return {
+        'n_queries': len(instances),
+        'max_score_difference': max_difference,
+        'passed': not mismatches and max_difference <= atol,
+        'mismatches': mismatches
+    }
+
+
+def main(config=None):
+    args = config or parse_args()
+
+    # both point to the model, so that it is used whether or not it is a bundle
+    TemplateSimilarityPredictor.BERT_NLI_PATH = args.model_path
+    TemplateSimilarityPredictor.BUNDLE_PATH = args.model_path
+
+    print('Exporting SciBERT to ONNX...')
+    export_onnx(args.model_path)
+
+    print('Verifying ONNX against PyTorch...')
+    report = verify_onnx(args.test_set_path, atol=args.atol)
+    print(report)
+
+    assert report['passed'], 'ONNX predictions diverge from the PyTorch ones.'
+
+
+if __name__ == '__main__':
+    main()
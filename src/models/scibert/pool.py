@@ -0,0 +1,93 @@
+import copy
+import os
+import threading
+from contextlib import contextmanager
+from queue import SimpleQueue
+
+import torch
+
+from src.models.scibert.service import TemplateSimilarityPredictor
+
+
+class PredictorPool:
+    """
+    Hands out SciBERT predictor replicas to concurrent threads, e.g. the request handlers of a threaded server.
+
+    A replica is only used by one thread at a time. With ``share_model`` the replicas are shallow copies of the
+    singleton predictor: they share its model, whose inference is read-only, and only own their premise cache.
+    Otherwise every replica loads its own model. With more than one replica, torch's intra-op threads are split
+    between them, so that concurrent forward passes do not oversubscribe the cores. A single replica keeps all
+    threads for sequential queries.
+    """
+    __instance = None
+    __lock = threading.Lock()
+    N_REPLICAS = 1
+    SHARE_MODEL = True
+
+    def __init__(self, n_replicas=None, share_model=None, n_threads=None):
+        self.n_replicas = n_replicas or PredictorPool.N_REPLICAS
+        self.share_model = PredictorPool.SHARE_MODEL if share_model is None else share_model
+        if self.n_replicas > 1 or n_threads:
+            torch.set_num_threads(n_threads or max(1, (os.cpu_count() or 1) // self.n_replicas))
+        self.n_threads = torch.get_num_threads()
+
+        self.replicas = SimpleQueue()
+        for _ in range(self.n_replicas):
+            self.replicas.put(self.create_replica())
+
+    @staticmethod
+    def get_instance():
+        with PredictorPool.__lock:
+            if PredictorPool.__instance is None:
+                PredictorPool.__instance = PredictorPool()
+
+        return PredictorPool.__instance
+
+    def create_replica(self):
+        if self.share_model:
+            return copy.copy(TemplateSimilarityPredictor.get_instance())
+
+        return TemplateSimilarityPredictor()
+
+    @contextmanager
+    def acquire(self):
+        """
+        Blocks until a replica is free and returns it to the pool when the block is left.
+        """
+        predictor = self.replicas.get()
+        try:
+            yield predictor
+        finally:
+            self.replicas.put(predictor)
+
+    def predict_similar_templates(self, q, batch_size=None, template_ids=None):
+        with self.acquire() as predictor:
+            return predictor.predict_similar_templates(q, batch_size=batch_size, template_ids=template_ids)
+
+    def predict_pairs(self, pairs, batch_size=None):
+        with self.acquire() as predictor:
+            return predictor.predict_pairs(pairs, batch_size=batch_size)
+
+    def load_premises(self):
+        with self.acquire() as predictor:
+            return predictor.load_premises()
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert predictor pool.
+    """
+    parser.add_argument('--replicas',
+                        type=int,
+                        default=PredictorPool.N_REPLICAS,
+                        required=False,
+                        help='Number of scibert predictors that serve concurrent queries, e.g. of the serve task. '
+                             'They share one model and split its threads.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert predictor pool.
+    """
+    PredictorPool.N_REPLICAS = getattr(config, 'replicas', None) or PredictorPool.N_REPLICAS
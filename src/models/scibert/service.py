@@ -1,53 +1,130 @@
 import os
 import re
+import threading
 
 import torch
-import torch.nn as nn
-from transformers import BertModel, BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizer
 
 from src import MODELS_DIR, PROCESSED_DATA_DIR
+from src.models.scibert.backends import BACKENDS, PRECISIONS, SAFETENSORS_FILE_NAME, create_backend
+from src.util.cache import directory_signature, file_digest
 from src.util.io import Reader
 
 
 class TemplateSimilarityPredictor:
     __instance = None
+    __lock = threading.Lock()
     BERT_TOKENIZER_PATH = 'allenai/scibert_scivocab_uncased'
     BERT_NLI_PATH = os.path.join(MODELS_DIR, 'orkgnlp-templates-recommendation-scibert')
+    BUNDLE_PATH = os.path.join(MODELS_DIR, 'orkgnlp-templates-recommendation-scibert-bundle')
     PREMISES_PATH = os.path.join(PROCESSED_DATA_DIR, 'dataset_premises.json')
     MAX_SEQUENCE_LENGTH = 512
+    BATCH_SIZE = 8
+    BACKEND = 'torch'
+    PRECISION = 'fp32'
     CLASSES = {
         '0': 'entailment',
         '1': 'contradiction',
         '2': 'neutral'
     }
 
-    def __init__(self):
-        if TemplateSimilarityPredictor.__instance is not None:
-            raise Exception("This class is a singleton!")
-        else:
-            TemplateSimilarityPredictor.__instance = self
-
+    def __init__(self, backend=None, precision=None):
         self.device = torch.device('cpu')
-        self.bert_tokenizer = BertTokenizer.from_pretrained(TemplateSimilarityPredictor.BERT_TOKENIZER_PATH)
-        self.bert_nli_model = BertForSequenceClassification.from_pretrained(TemplateSimilarityPredictor.BERT_NLI_PATH)
-        self.premises = Reader.read_json(TemplateSimilarityPredictor.PREMISES_PATH)
+        self.bert_tokenizer = TemplateSimilarityPredictor.load_tokenizer()
+        self.backend = create_backend(backend or TemplateSimilarityPredictor.BACKEND,
+                                      TemplateSimilarityPredictor.model_path(),
+                                      precision or TemplateSimilarityPredictor.PRECISION)
+        self.premises = None
+        self.premises_signature = None
+        self.premises_tokens = {}
+        self.load_premises()
 
     @staticmethod
     def get_instance():
-        if TemplateSimilarityPredictor.__instance:
-            return TemplateSimilarityPredictor.__instance
+        with TemplateSimilarityPredictor.__lock:
+            if TemplateSimilarityPredictor.__instance is None:
+                TemplateSimilarityPredictor.__instance = TemplateSimilarityPredictor()
 
-        return TemplateSimilarityPredictor()
+        return TemplateSimilarityPredictor.__instance
 
-    def predict_similar_templates(self, q):
-        similar_templates = []
+    @staticmethod
+    def model_path():
+        """
+        :return: the model bundle if it was created, otherwise the NLI checkpoint.
+        """
+        if os.path.exists(os.path.join(TemplateSimilarityPredictor.BUNDLE_PATH, SAFETENSORS_FILE_NAME)):
+            return TemplateSimilarityPredictor.BUNDLE_PATH
+
+        return TemplateSimilarityPredictor.BERT_NLI_PATH
+
+    @staticmethod
+    def load_tokenizer():
+        """
+        Loads the tokenizer from the model bundle without network access, or from ``BERT_TOKENIZER_PATH``.
+        """
+        if TemplateSimilarityPredictor.model_path() == TemplateSimilarityPredictor.BUNDLE_PATH:
+            return BertTokenizer.from_pretrained(TemplateSimilarityPredictor.BUNDLE_PATH, local_files_only=True)
+
+        return BertTokenizer.from_pretrained(TemplateSimilarityPredictor.BERT_TOKENIZER_PATH)
+
+    @staticmethod
+    def version():
+        """
+        :return: identifies the configured model and premises, e.g. to invalidate cached predictions.
+        """
+        return [
+            TemplateSimilarityPredictor.BACKEND,
+            TemplateSimilarityPredictor.PRECISION,
+            directory_signature(TemplateSimilarityPredictor.model_path()),
+            file_digest(TemplateSimilarityPredictor.PREMISES_PATH)
+        ]
+
+    def load_premises(self):
+        """
+        Reads the premises file and caches the token ids of every premise. The cache is only
+        rebuilt if the file has changed since the last call.
+        """
+        stat = os.stat(TemplateSimilarityPredictor.PREMISES_PATH)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        if signature == self.premises_signature:
+            return self.premises
+
+        premises = Reader.read_json(TemplateSimilarityPredictor.PREMISES_PATH)
+        self.premises_tokens = {
+            template['premise']: self.tokenize(template['premise']) for template in premises['templates']
+        }
+        self.premises = premises
+        self.premises_signature = signature
+
+        return self.premises
+
+    def predict_similar_templates(self, q, batch_size=None, template_ids=None):
+        """
+        :param template_ids: if given, only these templates are scored.
+        """
+        templates = self.load_premises()['templates']
+        if template_ids is not None:
+            template_ids = set(template_ids)
+            templates = [template for template in templates if template['id'] in template_ids]
 
         # We iterate the templates the model trained on to produce the class from the service perspective.
-        for template in self.premises['templates']:
-            premise = template['premise']
+        pairs = [(template['premise'], q) for template in templates]
+        predictions = self.predict_pairs(pairs, batch_size=batch_size)
 
-            label, score = self.predict_similar_template(premise, q)
+        return TemplateSimilarityPredictor.collect_similar_templates(templates, predictions)
 
+    @staticmethod
+    def collect_similar_templates(templates, predictions):
+        """
+        Keeps the entailed templates and sorts them by their score.
+
+        :param templates: list of templates as stored in the premises file.
+        :param predictions: list of (label, score) tuples aligned with ``templates``.
+        """
+        similar_templates = []
+
+        for template, (label, score) in zip(templates, predictions):
             if TemplateSimilarityPredictor.CLASSES[str(label)] == 'entailment':
                 similar_templates.append({
                     'template_id': template['id'],
@@ -60,27 +137,98 @@ class TemplateSimilarityPredictor:
         return similar_templates
 
     def predict_similar_template(self, template_string, paper_string):
-        self.bert_nli_model.eval()
+        return self.predict_pairs([(template_string, paper_string)])[0]
+
+    def predict_pairs(self, pairs, batch_size=None):
+        """
+        Scores (premise, hypothesis) pairs in padded batches.
+
+        :param pairs: list of (template_string, paper_string) tuples.
+        :param batch_size: number of pairs per forward pass. Defaults to ``BATCH_SIZE``.
+        :return: list of (label, score) tuples in the same order as ``pairs``.
+        """
+        batch_size = batch_size or TemplateSimilarityPredictor.BATCH_SIZE
 
         # premise = templates_string, hypothesis = paper_string
-        sequence = '[CLS] {} [SEP] {} [SEP]'.format(Utils.post_process(template_string),
-                                                    Utils.post_process(paper_string))
-        sequence_tokens = self.bert_tokenizer.tokenize(sequence)
+        # each distinct hypothesis is tokenized once, premises come from the cache.
+        hypotheses_tokens = {}
+        sequences = []
+        for template_string, paper_string in pairs:
+            premise_tokens = self.premises_tokens.get(template_string)
+            if premise_tokens is None:
+                premise_tokens = self.tokenize(template_string)
+
+            if paper_string not in hypotheses_tokens:
+                hypotheses_tokens[paper_string] = self.tokenize(paper_string)
+
+            sequences.append(self.encode(premise_tokens, hypotheses_tokens[paper_string]))
+
+        predictions = []
+        for i in range(0, len(sequences), batch_size):
+            predictions.extend(self._predict_batch(sequences[i:i + batch_size]))
+
+        return predictions
+
+    def tokenize(self, string):
+        tokens = self.bert_tokenizer.tokenize(Utils.post_process(string) or '')
+        return self.bert_tokenizer.convert_tokens_to_ids(tokens)
+
+    def encode(self, premise_tokens, hypothesis_tokens):
+        """
+        Builds the ``[CLS] premise [SEP] hypothesis [SEP]`` model inputs from already tokenized ids.
+        """
+        sequence_tokens = [self.bert_tokenizer.cls_token_id] + premise_tokens + \
+                          [self.bert_tokenizer.sep_token_id] + hypothesis_tokens + \
+                          [self.bert_tokenizer.sep_token_id]
 
         attention_mask = Utils.get_attention_mask(sequence_tokens)[:TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH]
-        token_type = Utils.get_token_type(sequence_tokens)[:TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH]
-        sequence_tokens = self.bert_tokenizer.convert_tokens_to_ids(sequence_tokens)[
-                          :TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH]
+        token_type = Utils.get_token_type(len(premise_tokens) + 2,
+                                          len(hypothesis_tokens) + 1)[:TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH]
+        sequence_tokens = sequence_tokens[:TemplateSimilarityPredictor.MAX_SEQUENCE_LENGTH]
+
+        return sequence_tokens, token_type, attention_mask
+
+    def _predict_batch(self, sequences):
+        sequence_tokens, token_type, attention_mask = Utils.pad(sequences, self.bert_tokenizer.pad_token_id)
+
+        attention_mask = torch.tensor(attention_mask).to(self.device)
+        token_type = torch.tensor(token_type).to(self.device)
+        sequence_tokens = torch.tensor(sequence_tokens).to(self.device)
 
-        attention_mask = torch.tensor(attention_mask).unsqueeze(0).to(self.device)
-        token_type = torch.tensor(token_type).unsqueeze(0).to(self.device)
-        sequence_tokens = torch.tensor(sequence_tokens).unsqueeze(0).to(self.device)
+        logits = self.backend(sequence_tokens, attention_mask, token_type)
+        labels = logits.argmax(dim=-1)
+        scores = logits.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
 
-        prediction = self.bert_nli_model(sequence_tokens, attention_mask, token_type)
-        label = prediction.logits.argmax(dim=-1).item()
-        score = prediction.logits[0][label].item()
+        return list(zip(labels.tolist(), scores.tolist()))
 
-        return label, score
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert approaches.
+    """
+    parser.add_argument('-b', '--backend',
+                        choices=list(BACKENDS.keys()),
+                        default=TemplateSimilarityPredictor.BACKEND,
+                        required=False,
+                        help='Inference backend of the scibert approach. '
+                             'onnx requires an exported graph (python -m src.models.scibert.export).'
+                        )
+
+    parser.add_argument('-p', '--precision',
+                        choices=PRECISIONS,
+                        default=TemplateSimilarityPredictor.PRECISION,
+                        required=False,
+                        help='Numerical precision of the scibert approach on the torch backend. '
+                             'int8 quantizes the Linear layers dynamically, bf16 requires CPU support.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert approaches.
+    """
+    TemplateSimilarityPredictor.BACKEND = getattr(config, 'backend', None) or TemplateSimilarityPredictor.BACKEND
+    TemplateSimilarityPredictor.PRECISION = getattr(config, 'precision', None) or TemplateSimilarityPredictor.PRECISION
 
 
 class Utils:
@@ -90,9 +238,26 @@ class Utils:
         return [1] * len(tokens)
 
     @staticmethod
-    def get_token_type(tokens):
-        sep_index = tokens.index('[SEP]') + 1
-        return [0] * sep_index + [1] * (len(tokens) - sep_index)
+    def get_token_type(n_first_segment, n_second_segment):
+        return [0] * n_first_segment + [1] * n_second_segment
+
+    @staticmethod
+    def pad(sequences, pad_token_id=0):
+        """
+        Right-pads encoded sequences to the longest one in the batch. Padded positions are masked out.
+
+        :param sequences: list of (sequence_tokens, token_type, attention_mask) tuples.
+        """
+        max_length = max(len(sequence_tokens) for sequence_tokens, _, _ in sequences)
+
+        batch_tokens, batch_token_type, batch_attention_mask = [], [], []
+        for sequence_tokens, token_type, attention_mask in sequences:
+            padding = max_length - len(sequence_tokens)
+            batch_tokens.append(sequence_tokens + [pad_token_id] * padding)
+            batch_token_type.append(token_type + [0] * padding)
+            batch_attention_mask.append(attention_mask + [0] * padding)
+
+        return batch_tokens, batch_token_type, batch_attention_mask
 
     @staticmethod
     def post_process(string, is_query=False):
@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.multiprocessing as mp
+
+from src import PROCESSED_DATA_DIR
+from src.models.scibert.backends import TorchBackend
+from src.models.scibert.service import TemplateSimilarityPredictor
+from src.util.io import Reader
+
+SHARDINGS = ['premises', 'queries']
+
+# predictor of a worker process, inherited from or sent by the parent when the worker starts
+worker_predictor = None
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-testp', '--test_set_path',
+                        type=str,
+                        default=os.path.join(PROCESSED_DATA_DIR, 'test_set.json'),
+                        required=False,
+                        help='Path to the test set whose hypotheses are used as queries.'
+                        )
+
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        required=False,
+                        help='Largest number of worker processes to benchmark.'
+                        )
+
+    parser.add_argument('--sharding',
+                        choices=SHARDINGS,
+                        default='queries',
+                        required=False,
+                        help='premises: every query is split across all workers by template. '
+                             'queries: every query is scored by one worker.'
+                        )
+
+    parser.add_argument('--n_queries',
+                        type=int,
+                        default=64,
+                        required=False,
+                        help='Number of test set hypotheses queried per run.'
+                        )
+    return parser.parse_args()
+
+
+class WorkerPool:
+    """
+    Runs the SciBERT predictor in ``n_workers`` processes that share one copy of the model weights, so that
+    tokenization and the surrounding Python work are not bound to a single interpreter.
+
+    The model is loaded once in the parent. Forked workers inherit its weights copy-on-write; with another start
+    method the weights are moved to shared memory first. A pool created outside the main thread uses ``forkserver``
+    instead of ``fork``. Every worker is limited to its share of the intra-op threads, so that the workers do not
+    oversubscribe the cores.
+    """
+    __instance = None
+    __lock = threading.Lock()
+    N_WORKERS = 0
+    SHARDING = 'premises'
+    START_METHOD = 'fork'
+
+    def __init__(self, n_workers=None, sharding=None, predictor=None):
+        self.n_workers = n_workers or WorkerPool.N_WORKERS or os.cpu_count()
+        self.sharding = sharding or WorkerPool.SHARDING
+        self.predictor = predictor or TemplateSimilarityPredictor.get_instance()
+
+        if not isinstance(self.predictor.backend, TorchBackend):
+            raise ValueError('Worker processes are only supported by the torch backend.')
+
+        # forking a process that already runs other threads can deadlock the workers on locks held by those threads
+        start_method = WorkerPool.START_METHOD
+        if start_method == 'fork' and threading.current_thread() is not threading.main_thread():
+            start_method = 'forkserver'
+
+        if start_method != 'fork':
+            self.predictor.backend.model.share_memory()
+
+        n_threads = max(1, torch.get_num_threads() // self.n_workers)
+        self.pool = mp.get_context(start_method).Pool(self.n_workers,
+                                                                 initializer=initialize_worker,
+                                                                 initargs=(self.predictor, n_threads))
+
+    @staticmethod
+    def get_instance():
+        with WorkerPool.__lock:
+            if WorkerPool.__instance is None:
+                WorkerPool.__instance = WorkerPool()
+
+        return WorkerPool.__instance
+
+    def predict_similar_templates(self, q, batch_size=None, template_ids=None):
+        """
+        Same as ``TemplateSimilarityPredictor.predict_similar_templates``, computed by the worker processes.
+        """
+        if self.sharding == 'queries':
+            return self.pool.apply(predict_similar_templates, (q, batch_size, template_ids))
+
+        templates = self.predictor.load_premises()['templates']
+        if template_ids is not None:
+            template_ids = set(template_ids)
+            templates = [template for template in templates if template['id'] in template_ids]
+
+        ids = [template['id'] for template in templates]
+        shards = [ids[i::self.n_workers] for i in range(self.n_workers)]
+        results = self.pool.starmap(predict_similar_templates, [(q, batch_size, shard) for shard in shards if shard])
+
+        similar_templates = [similar_template for result in results for similar_template in result]
+        return sorted(similar_templates, key=lambda i: i['score'], reverse=True)
+
+    def predict_many(self, queries, batch_size=None):
+        """
+        Scores every query on one worker, keeping all workers busy.
+
+        :return: list of similar templates aligned with ``queries``.
+        """
+        return self.pool.starmap(predict_similar_templates, [(q, batch_size, None) for q in queries], chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def initialize_worker(predictor, n_threads):
+    global worker_predictor
+
+    torch.set_num_threads(n_threads)
+    worker_predictor = predictor
+
+
+def predict_similar_templates(q, batch_size, template_ids):
+    return worker_predictor.predict_similar_templates(q, batch_size=batch_size, template_ids=template_ids)
+
+
+def benchmark(queries, max_workers, sharding='queries'):
+    """
+    Measures the throughput of the worker pool with 1, 2, 4, ... up to ``max_workers`` workers.
+
+    :return: dict of the number of workers to the queries per second and the speedup over one worker.
+    """
+    predictor = TemplateSimilarityPredictor.get_instance()
+
+    report = {}
+    n_workers = 1
+    while n_workers <= max_workers:
+        pool = WorkerPool(n_workers, sharding, predictor)
+
+        if sharding == 'queries':
+            pool.predict_many(queries[:n_workers])
+        else:
+            pool.predict_similar_templates(queries[0])
+
+        start = time.perf_counter()
+        if sharding == 'queries':
+            pool.predict_many(queries)
+        else:
+            for q in queries:
+                pool.predict_similar_templates(q)
+        duration = time.perf_counter() - start
+        pool.close()
+
+        throughput = len(queries) / duration
+        report[n_workers] = {
+            'queries_per_second': throughput,
+            'speedup': throughput / report[1]['queries_per_second'] if report else 1.0
+        }
+        print('{} workers: {:.2f} queries/s'.format(n_workers, throughput))
+
+        n_workers = max_workers if n_workers < max_workers < n_workers * 2 else n_workers * 2
+
+    return report
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the scibert worker pool.
+    """
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=WorkerPool.N_WORKERS,
+                        required=False,
+                        help='Number of worker processes sharing the scibert model. 0 runs it in this process.'
+                        )
+
+    parser.add_argument('--sharding',
+                        choices=SHARDINGS,
+                        default=WorkerPool.SHARDING,
+                        required=False,
+                        help='Work split of the scibert worker processes. premises: every query is split across '
+                             'all workers by template. queries: every query is scored by one worker.'
+                        )
+
+
+def configure(config):
+    """
+    Applies the command line arguments of the scibert worker pool.
+    """
+    WorkerPool.N_WORKERS = getattr(config, 'workers', None) or WorkerPool.N_WORKERS
+    WorkerPool.SHARDING = getattr(config, 'sharding', None) or WorkerPool.SHARDING
+
+    # the tasks configure the approaches before they start threads, so the workers can still be forked safely
+    if WorkerPool.N_WORKERS:
+        WorkerPool.get_instance()
+
+
+def main(config=None):
+    args = config or parse_args()
+
+    test_set = Reader.read_json(args.test_set_path)
+    queries = [instance['hypothesis'] for instance in test_set['entailments'] + test_set['neutrals']]
+
+    print('Benchmarking SciBERT workers...')
+    print(benchmark(queries[:args.n_queries], args.workers, args.sharding))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import asyncio
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+
+from src.models import predict, registry
+
+APPROACHES = ['elasticsearch', 'scibert', 'baseline', 'baseline_full']
+
+# The baselines expect a research field ID as a query.
+WARMUP_QUERIES = {
+    'baseline': 'R11',
+    'baseline_full': 'R11'
+}
+WARMUP_QUERY = 'Open Research Knowledge Graph: a scholarly knowledge graph of research contributions'
+# seconds until a request retries to load an approach that failed, e.g. because elasticsearch was not up yet
+RETRY_INTERVAL = 10
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-a', '--approaches',
+                        choices=list(registry.APPROACHES.keys()),
+                        nargs='+',
+                        default=APPROACHES,
+                        required=False,
+                        help='Approaches that are preloaded and served.'
+                        )
+
+    add_arguments(parser)
+    registry.add_arguments(parser, registry.peek('-a', '--approaches') or APPROACHES)
+    return parser.parse_args()
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the serve task. The ones of the approaches are added by the registry.
+    """
+    parser.add_argument('--host',
+                        type=str,
+                        default='0.0.0.0',
+                        required=False,
+                        help='Interface the server listens on.'
+                        )
+
+    parser.add_argument('--port',
+                        type=int,
+                        default=8080,
+                        required=False,
+                        help='Port the server listens on.'
+                        )
+
+    parser.add_argument('--threads',
+                        type=int,
+                        default=4,
+                        required=False,
+                        help='Number of threads that run the blocking predictions.'
+                        )
+
+    predict.add_cache_arguments(parser)
+
+    parser.add_argument('--micro_batching',
+                        action='store_true',
+                        help='Scores concurrent scibert requests of the serve task together in shared forward '
+                             'passes of up to --batch_size pairs.'
+                        )
+
+    parser.add_argument('--async_elasticsearch',
+                        action='store_true',
+                        help='Serves elasticsearch queries with the asynchronous client on the event loop '
+                             'instead of the prediction threads.'
+                        )
+
+
+def create_app(approaches, n_threads=4, async_elasticsearch=False, micro_batching=False):
+    """
+    Creates the recommendation server. The approaches are preloaded in the background once the server started,
+    so that ``/health`` responds immediately while ``/ready`` only succeeds after the preloading.
+
+    :param async_elasticsearch: if True, elasticsearch queries are awaited on the event loop with the
+        asynchronous client instead of blocking a prediction thread.
+    :param micro_batching: if True, concurrent scibert requests are scored together by the ``MicroBatcher``.
+    """
+    app = web.Application()
+    app['approaches'] = approaches
+    app['async_elasticsearch'] = async_elasticsearch
+    app['micro_batching'] = micro_batching
+    app['status'] = {approach: 'loading' for approach in approaches}
+    app['failed_at'] = {}
+    app['ready'] = False
+    app['executor'] = ThreadPoolExecutor(n_threads, thread_name_prefix='recommendation')
+
+    app.router.add_get('/health', health)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/recommend', recommend)
+    app.router.add_post('/recommend', recommend)
+
+    app.on_startup.append(start_preloading)
+    app.on_cleanup.append(shutdown)
+
+    return app
+
+
+async def start_preloading(app):
+    # the locks are bound to the event loop of the server, which only runs from here on
+    app['locks'] = {approach: asyncio.Lock() for approach in app['approaches']}
+    app['preloading'] = asyncio.get_event_loop().create_task(preload(app))
+
+
+async def preload(app):
+    """
+    Loads the models of every approach and warms them up with one prediction. An approach that fails to load
+    is reported by ``/ready`` and loaded again by the next ``/recommend`` request after ``RETRY_INTERVAL`` seconds,
+    the others are served regardless.
+    """
+    for approach in app['approaches']:
+        await load(app, approach)
+
+    app['ready'] = True
+
+
+async def load(app, approach):
+    async with app['locks'][approach]:
+        if app['status'][approach] == 'ready':
+            return
+
+        start = time.perf_counter()
+        try:
+            await asyncio.get_event_loop().run_in_executor(app['executor'], warm_up, approach)
+            app['status'][approach] = 'ready'
+            print('{} ready in {:.2f}s'.format(approach, time.perf_counter() - start))
+        except Exception as e:
+            app['status'][approach] = 'failed: {}'.format(e)
+            app['failed_at'][approach] = time.monotonic()
+            print('{} failed to load: {}'.format(approach, e))
+
+
+async def retry(app, approach):
+    """
+    Loads ``approach`` again if it failed at least ``RETRY_INTERVAL`` seconds ago.
+    """
+    if app['status'][approach].startswith('failed') and \
+            time.monotonic() - app['failed_at'][approach] >= RETRY_INTERVAL:
+        await load(app, approach)
+
+
+def warm_up(approach):
+    predict.predict(approach, WARMUP_QUERIES.get(approach, WARMUP_QUERY), n_results=1)
+
+
+async def shutdown(app):
+    app['preloading'].cancel()
+    app['executor'].shutdown(wait=False)
+
+    if app['async_elasticsearch']:
+        await predict.es.close_async_client()
+
+
+async def health(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def ready(request):
+    """
+    Succeeds once the preloading finished and at least one approach can be served. Approaches that failed to load
+    are retried, so that a readiness probe recovers the service even before it receives requests.
+    """
+    app = request.app
+    if app['ready']:
+        for approach in app['approaches']:
+            await retry(app, approach)
+
+    is_ready = app['ready'] and 'ready' in app['status'].values()
+
+    return web.json_response({
+        'ready': is_ready,
+        'approaches': app['status']
+    }, status=200 if is_ready else 503)
+
+
+async def stats(request):
+    """
+    Reports the hits and misses of the query cache.
+    """
+    return web.json_response({'cache': predict.cache.stats()})
+
+
+async def recommend(request):
+    """
+    Recommends templates for a paper. The parameters are read from the query string or a JSON body:
+
+    * ``q``: paper textual representation, or a research field ID for the baselines.
+    * ``approach``: one of the served approaches. Defaults to the first one.
+    * ``n_results``: number of results to be retrieved. Defaults to 20.
+    * ``research_field``: research field ID of the paper, used by elasticsearch and scibert_cascade.
+    """
+    app = request.app
+    params = dict(request.query)
+    if request.method == 'POST' and request.can_read_body:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text='The request body must be a JSON object.')
+        params.update(body)
+
+    q = params.get('q')
+    approach = params.get('approach', app['approaches'][0])
+    n_results = params.get('n_results', 20)
+    research_field = params.get('research_field')
+
+    if not q or not isinstance(q, str):
+        raise web.HTTPBadRequest(text='q must be provided as a string.')
+
+    if not isinstance(approach, str) or approach not in app['status']:
+        raise web.HTTPBadRequest(text='approach must be one of {}.'.format(app['approaches']))
+
+    # bool is a subclass of int, but true is no number of results
+    if isinstance(n_results, bool) or not isinstance(n_results, (int, str)):
+        raise web.HTTPBadRequest(text='n_results must be a positive integer.')
+
+    try:
+        n_results = int(n_results)
+    except ValueError:
+        raise web.HTTPBadRequest(text='n_results must be a positive integer.')
+
+    if n_results < 1:
+        raise web.HTTPBadRequest(text='n_results must be a positive integer.')
+
+    if research_field is not None and not isinstance(research_field, str):
+        raise web.HTTPBadRequest(text='research_field must be a string.')
+
+    await retry(app, approach)
+
+    if app['status'][approach] != 'ready':
+        raise web.HTTPServiceUnavailable(text='{} is {}.'.format(approach, app['status'][approach]))
+
+    if approach == 'elasticsearch' and app['async_elasticsearch']:
+        results = await predict.predict_elasticsearch_async(q, n_results, research_field)
+    else:
+        results = await asyncio.get_event_loop().run_in_executor(app['executor'], partial(
+            predict.predict, approach, q, n_results, research_field, app['micro_batching']))
+
+    return web.json_response({
+        'approach': approach,
+        'results': results
+    })
+
+
+def main(config=None):
+    args = config or parse_args()
+    approaches = getattr(args, 'approaches', None) or \
+                 ([args.approach] if getattr(args, 'approach', None) else APPROACHES)
+
+    for approach in approaches:
+        registry.configure(approach, args)
+
+    if args.cache_path:
+        predict.cache.open(args.cache_path)
+
+    print('Serving {} on {}:{}...'.format(approaches, args.host, args.port))
+    # worker processes score every query in parallel already, like in predict_stream
+    micro_batching = args.micro_batching and not getattr(args, 'workers', None)
+    app = create_app(approaches, args.threads, args.async_elasticsearch, micro_batching)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
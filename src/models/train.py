@@ -1,35 +1,111 @@
 from argparse import ArgumentParser
+from functools import partial
 
-import src.models.elasticsearch.service as es
-import src.models.baseline.service as baseline
+from src.models import registry
+from src.util.lazy import lazy_import
+
+es = lazy_import('src.models.elasticsearch.service')
+bm25 = lazy_import('src.models.bm25.service')
+baseline = lazy_import('src.models.baseline.service')
+knn = lazy_import('src.models.knn.service')
+biencoder = lazy_import('src.models.scibert.biencoder')
 
 
 def parse_args():
     parser = ArgumentParser()
 
     parser.add_argument('-a', '--approach',
-                        choices=['elasticsearch', 'scibert', 'baseline', 'baseline_full'],
+                        choices=list(registry.APPROACHES.keys()),
                         required=True,
-                        help='Indicates the approach to evaluate.'
+                        help='Indicates the approach to train.'
                         )
 
+    add_arguments(parser)
+    registry.add_arguments(parser, registry.peek('-a', '--approach'))
+    return parser.parse_args()
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments of the train task. The ones of the approaches are added by the registry.
+    """
     parser.add_argument('-trainp', '--training_set_path',
                         type=str,
                         required=False,
                         help='Path to training set.'
                         )
 
-    return parser.parse_args()
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Updates the existing model with the training set instead of rebuilding it. '
+                             'Supported by elasticsearch and scibert_knn.'
+                        )
+
+    parser.add_argument('--from_triplestore',
+                        action='store_true',
+                        help='Builds the elasticsearch index directly from the triple store and the papers dump '
+                             'instead of the training set.'
+                        )
 
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=500,
+                        required=False,
+                        help='Number of documents per bulk request when building the elasticsearch index.'
+                        )
+
+    parser.add_argument('--bulk_threads',
+                        type=int,
+                        default=4,
+                        required=False,
+                        help='Number of concurrent bulk requests when building the elasticsearch index.'
+                        )
+
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='Number of shards of a new elasticsearch index. The documents are routed to the '
+                             'shards by research field.'
+                        )
+
+
+def train_elasticsearch(training_set_path, from_triplestore=False, incremental=False):
+    """
+    :param from_triplestore: if True, the index is built from the triple store instead of the training set.
+    :param incremental: if True, only the changed documents of the current index are updated.
+    """
+    if from_triplestore:
+        training_set_path = None
+
+    if incremental:
+        return es.update_index(training_set_path)
 
-def train_elasticsearch(training_set_path):
     return es.recreate_index(training_set_path)
 
 
+def train_bm25(training_set_path):
+    return bm25.create_index(training_set_path)
+
+
 def train_scibert(training_set_path):
     raise NotImplementedError
 
 
+def train_scibert_biencoder(training_set_path):
+    """
+    :param training_set_path: must point to the premises file, e.g. ``data/processed/dataset_premises.json``.
+    """
+    return biencoder.TemplateEmbeddingPredictor.get_instance().create_embeddings(training_set_path)
+
+
+def train_scibert_knn(training_set_path, incremental=False):
+    if incremental:
+        return knn.update_index(training_set_path)
+
+    return knn.create_index(training_set_path)
+
+
 def train_baseline(training_set_path):
     return baseline.create_templates_fields_map(training_set_path)
 
@@ -42,12 +118,20 @@ def main(config=None):
     args = config or parse_args()
 
     assert args.approach, 'approach must be provided.'
-    assert args.training_set_path, 'training_set_path must be provided.'
+    assert args.training_set_path or args.from_triplestore, 'training_set_path must be provided.'
+    assert args.approach != 'scibert_cascade', \
+        'scibert_cascade has nothing to train, it builds its first stage from the premises when it is queried.'
+
+    registry.configure(args.approach, args)
 
     print('Building Elasticsearch Index...')
     info = {
-        'elasticsearch': train_elasticsearch,
+        'elasticsearch': partial(train_elasticsearch, from_triplestore=args.from_triplestore,
+                                 incremental=args.incremental),
+        'bm25': train_bm25,
         'scibert': train_scibert,
+        'scibert_biencoder': train_scibert_biencoder,
+        'scibert_knn': partial(train_scibert_knn, incremental=args.incremental),
         'baseline': train_baseline,
         'baseline_full': train_baseline_full
     }[args.approach](args.training_set_path)
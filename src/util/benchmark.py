@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+from src import CURRENT_DIR
+from src.models import registry
+
+IMPORT_SCRIPT = """import time
+start = time.perf_counter()
+from src.models import registry, {task}
+registry.load('{approach}')
+print(time.perf_counter() - start)"""
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('-t', '--task',
+                        choices=['train', 'evaluate', 'predict'],
+                        default='predict',
+                        required=False,
+                        help='Task whose import time is measured.'
+                        )
+
+    parser.add_argument('-r', '--repetitions',
+                        type=int,
+                        default=5,
+                        required=False,
+                        help='Number of fresh interpreters per approach. The fastest run is reported.'
+                        )
+    return parser.parse_args()
+
+
+def measure_import_time(task, approach, repetitions=5):
+    """
+    Measures in fresh interpreters how long importing ``task`` and the backends of ``approach`` takes.
+
+    :return: the fastest import time in seconds.
+    """
+    script = IMPORT_SCRIPT.format(task=task, approach=approach)
+
+    timings = []
+    for _ in range(repetitions):
+        output = subprocess.run([sys.executable, '-c', script],
+                                cwd=os.path.join(CURRENT_DIR, '..'),
+                                capture_output=True,
+                                check=True,
+                                text=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+
+    return min(timings)
+
+
+def main(config=None):
+    args = config or parse_args()
+
+    print('Measuring import times of {}...'.format(args.task))
+    results = {}
+    for approach in registry.APPROACHES.keys():
+        results[approach] = measure_import_time(args.task, approach, args.repetitions)
+        print('{}: {:.3f}s'.format(approach, results[approach]))
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from src.util.string import post_process
+
+
+class QueryCache:
+    """
+    Two-tier cache for query results: an in-memory LRU with size and TTL eviction, backed by an optional sqlite
+    file that survives restarts. Values must be JSON-serializable.
+    """
+    MAX_SIZE = 1024
+    TTL = 3600
+
+    def __init__(self, max_size=None, ttl=None, path=None):
+        self.max_size = max_size or QueryCache.MAX_SIZE
+        self.ttl = ttl or QueryCache.TTL
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection = None
+
+        if path:
+            self.open(path)
+
+    def open(self, path):
+        """
+        Enables the on-disk tier at ``path``.
+        """
+        with self.lock:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)')
+            # every write expires the old results, the index spares it a scan of the whole table
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_created ON results (created)')
+            self.connection.commit()
+
+    def get(self, key):
+        """
+        :return: the cached value or None.
+        """
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self.entries[key]
+
+            if self.connection is not None:
+                row = self.connection.execute('SELECT value, created FROM results WHERE key = ? AND created > ?',
+                                              (key, now - self.ttl)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._put(key, value, row[1])
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+
+        with self.lock:
+            self._put(key, value, now)
+
+            if self.connection is not None:
+                self.connection.execute('INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)',
+                                        (key, json.dumps(value), now))
+                self.connection.execute('DELETE FROM results WHERE created <= ?', (now - self.ttl,))
+                self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+            if self.connection is not None:
+                self.connection.execute('DELETE FROM results')
+                self.connection.commit()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+    def _put(self, key, value, created):
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def make_key(q, approach, version, **kwargs):
+        """
+        :param q: query, normalized before hashing so that formatting differences hit the same entry.
+        :param version: identifies the model and data the results were computed with.
+        """
+        key = json.dumps([post_process(q), approach, version, sorted(kwargs.items())])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cached(cache, approach, version, ignore=()):
+    """
+    Caches the results of a ``predict_*`` function in ``cache``.
+
+    :param version: callable returning the current model version of the approach.
+    :param ignore: names of keyword arguments that do not change the results, e.g. how they are computed.
+        They are left out of the key.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(q, n_results=20, **kwargs):
+            key_kwargs = {name: value for name, value in kwargs.items() if name not in ignore}
+            key = QueryCache.make_key(q, approach, version(), n_results=n_results, **key_kwargs)
+
+            results = cache.get(key)
+            if results is None:
+                results = func(q, n_results, **kwargs)
+                cache.set(key, results)
+
+            return results
+
+        return wrapper
+
+    return decorator
+
+
+__digests__ = {}
+
+
+def file_digest(path):
+    """
+    :return: the SHA-1 of the file's content. It is only recomputed if the file's mtime or size change.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    # only the digest of the current version of every file is kept
+    entry = __digests__.get(path)
+    if entry is None or entry[0] != signature:
+        with open(path, 'rb') as f:
+            entry = (signature, hashlib.sha1(f.read()).hexdigest())
+        __digests__[path] = entry
+
+    return entry[1]
+
+
+def directory_signature(path, exclude=()):
+    """
+    :param exclude: names of files that are not part of the version.
+    :return: a cheap version of a directory based on the names, sizes and mtimes of its files.
+    """
+    signature = []
+    for file_name in sorted(set(os.listdir(path)) - set(exclude)):
+        stat = os.stat(os.path.join(path, file_name))
+        signature.append((file_name, stat.st_mtime_ns, stat.st_size))
+
+    return hashlib.sha1(json.dumps(signature).encode('utf-8')).hexdigest()
@@ -1,5 +1,6 @@
 import os
 import json
+import sys
 
 
 class Writer:
@@ -36,3 +37,26 @@ class Reader:
             json_data = json.load(f)
 
         return json_data
+
+    @staticmethod
+    def iterate_jsonl(input_path):
+        """
+        Lazily yields the objects of a JSON Lines file, or of stdin if ``input_path`` is ``-``. Blank lines are skipped.
+        """
+        for line in Reader.iterate_lines(input_path):
+            yield json.loads(line)
+
+    @staticmethod
+    def iterate_lines(input_path):
+        """
+        Lazily yields the non-blank lines of a file, or of stdin if ``input_path`` is ``-``.
+        """
+        f = sys.stdin if input_path == '-' else open(input_path, encoding='utf-8')
+
+        try:
+            for line in f:
+                if line.strip():
+                    yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
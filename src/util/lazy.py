@@ -0,0 +1,22 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported on first attribute access, so that heavy backends
+    (torch, transformers, elasticsearch, matplotlib) are only loaded by the approaches that use them.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+
+        return getattr(self.__module, attribute)
+
+
+def lazy_import(name):
+    return LazyModule(name)